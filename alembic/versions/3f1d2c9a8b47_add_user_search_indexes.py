@@ -0,0 +1,46 @@
+"""add user search column and indexes
+
+Revision ID: 3f1d2c9a8b47
+Revises: 6469a3ce275d
+Create Date: 2017-03-12 14:20:41.270153
+
+"""
+from alembic import op  # noqa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1d2c9a8b47'
+down_revision = '6469a3ce275d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    # Lower-cased "firstname lastname" for infix search by full name
+    op.execute("""
+        ALTER TABLE "user" ADD COLUMN fullname_search text
+        GENERATED ALWAYS AS (lower(firstname || ' ' || lastname)) STORED
+    """)
+    op.execute("""
+        CREATE INDEX user_fullname_search_trgm_idx ON "user"
+        USING gin (fullname_search gin_trgm_ops)
+    """)
+
+    # Case-insensitive prefix search by login (email)
+    op.execute("""
+        CREATE INDEX user_login_lower_pattern_idx ON "user"
+        (lower(login) text_pattern_ops)
+    """)
+
+    # Keyset pagination order of users list
+    op.create_index('user_fullname_key_idx', 'user',
+                    ['firstname', 'lastname', 'id'])
+
+
+def downgrade():
+    op.drop_index('user_fullname_key_idx', table_name='user')
+    op.drop_index('user_login_lower_pattern_idx', table_name='user')
+    op.drop_index('user_fullname_search_trgm_idx', table_name='user')
+    op.drop_column('user', 'fullname_search')
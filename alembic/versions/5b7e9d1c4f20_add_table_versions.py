@@ -0,0 +1,58 @@
+"""add table versions bumped by triggers
+
+Revision ID: 5b7e9d1c4f20
+Revises: 8c2e41f5d0a3
+Create Date: 2017-03-26 16:45:02.194310
+
+"""
+from alembic import op  # noqa
+import sqlalchemy as sa  # noqa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e9d1c4f20'
+down_revision = '8c2e41f5d0a3'
+branch_labels = None
+depends_on = None
+
+# Tables whose responses carry ETag derived from version
+VERSIONED_TABLES = ['roles']
+
+
+def upgrade():
+    op.create_table(
+        'table_versions',
+        sa.Column('table_name', sa.String(64), nullable=False),
+        sa.Column('version', sa.BigInteger, nullable=False,
+                  server_default='1'),
+        sa.PrimaryKeyConstraint('table_name', name='table_versions_pkey'),
+    )
+
+    # One bump per modifying statement, not per row
+    op.execute("""
+        CREATE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO table_versions (table_name) VALUES (TG_TABLE_NAME)
+            ON CONFLICT (table_name)
+            DO UPDATE SET version = table_versions.version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+    for table in VERSIONED_TABLES:
+        op.execute(
+            "INSERT INTO table_versions (table_name) VALUES ('{0}')"
+            .format(table))
+        op.execute("""
+            CREATE TRIGGER {0}_version_trigger
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {0}
+            FOR EACH STATEMENT EXECUTE PROCEDURE bump_table_version()
+        """.format(table))
+
+
+def downgrade():
+    for table in VERSIONED_TABLES:
+        op.execute('DROP TRIGGER {0}_version_trigger ON {0}'.format(table))
+    op.execute('DROP FUNCTION bump_table_version()')
+    op.drop_table('table_versions')
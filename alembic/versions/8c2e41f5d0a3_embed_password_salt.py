@@ -0,0 +1,46 @@
+"""embed salt into self-describing password hash
+
+Revision ID: 8c2e41f5d0a3
+Revises: 3f1d2c9a8b47
+Create Date: 2017-03-19 11:02:13.518640
+
+"""
+from alembic import op  # noqa
+import sqlalchemy as sa  # noqa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c2e41f5d0a3'
+down_revision = '3f1d2c9a8b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Both changes only touch catalog, table is not rewritten
+    op.alter_column('user', 'password', type_=sa.Text,
+                    existing_type=sa.String(256), existing_nullable=False)
+    op.alter_column('user', 'salt', nullable=True,
+                    existing_type=sa.String(256))
+
+    # Salts are moved into password hashes after upgrade by
+    # `maplocate embed-password-salts` in batches, application verifies
+    # both forms meanwhile.
+
+
+def downgrade():
+    # Only legacy SHA-512 hashes can be split back, other users must
+    # reset their passwords after downgrade.
+    op.execute(r"""
+        UPDATE "user" SET
+            salt = split_part(password, '$', 2),
+            password = split_part(password, '$', 3)
+        WHERE salt IS NULL AND password LIKE 'sha512$%'
+    """)
+    op.execute("""
+        UPDATE "user" SET salt = '' WHERE salt IS NULL
+    """)
+    op.alter_column('user', 'salt', nullable=False,
+                    existing_type=sa.String(256))
+    op.alter_column('user', 'password', type_=sa.String(256),
+                    existing_type=sa.Text, existing_nullable=False)
@@ -0,0 +1,68 @@
+"""Login latency benchmark.
+
+Runs concurrent logins against running maplocate service and prints
+latency percentiles. Run it before and after a change on the same data:
+
+    python benchmarks/login.py --url http://localhost:8081 \\
+        --login admin@example.com --password secret -n 2000 -c 20
+"""
+import argparse
+import asyncio
+import time
+
+from maplocate.http_client import RestClient
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    index = max(int(round(percent / 100 * len(values))) - 1, 0)
+    return values[index]
+
+
+@asyncio.coroutine
+def login_worker(client, options, latencies, counter):
+    while next(counter, None) is not None:
+        started = time.perf_counter()
+        yield from client.login(options.login, options.password)
+        latencies.append(time.perf_counter() - started)
+
+
+@asyncio.coroutine
+def run(options, loop):
+    client = RestClient(options.url, loop=loop)
+    latencies = []
+    counter = iter(range(options.requests))
+    started = time.perf_counter()
+    try:
+        yield from asyncio.gather(
+            *[login_worker(client, options, latencies, counter)
+              for _ in range(options.concurrency)],
+            loop=loop)
+    finally:
+        client.close()
+    return latencies, time.perf_counter() - started
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--url', default='http://localhost:8081')
+    ap.add_argument('--login', required=True)
+    ap.add_argument('--password', required=True)
+    ap.add_argument('-n', '--requests', type=int, default=1000)
+    ap.add_argument('-c', '--concurrency', type=int, default=10)
+    options = ap.parse_args()
+
+    loop = asyncio.get_event_loop()
+    latencies, elapsed = loop.run_until_complete(run(options, loop))
+    loop.close()
+
+    latencies.sort()
+    print('requests: {}, concurrency: {}, {:.1f} req/s'.format(
+        len(latencies), options.concurrency, len(latencies) / elapsed))
+    for percent in (50, 90, 99):
+        print('p{}: {:.2f} ms'.format(
+            percent, percentile(latencies, percent) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Output views benchmark.
+
+Compares trafaret views used before with generated projections of
+maplocate.admin.views on rows shaped like users_list and roles_list ones:
+
+    python benchmarks/views.py -n 10000
+"""
+import argparse
+import timeit
+
+import trafaret as t
+
+from maplocate.admin.views import UserView, RoleView
+
+# Same as maplocate.admin.permissions.Permission values
+PERMISSIONS = ['roles_view', 'roles_edit', 'users_view', 'users_add',
+               'users_edit', 'users_reset_password', 'users_roles_edit']
+
+
+TrafaretUserView = t.Dict({
+    t.Key('id') >> 'uid': t.Int[0:],
+    t.Key('login'): t.String,
+    t.Key('firstname', default=''): t.String(allow_blank=True, max_length=64),
+    t.Key('lastname', default=''): t.String(allow_blank=True, max_length=64),
+    t.Key('roles', default=list): t.List(t.Dict({
+        t.Key('id'): t.Int[0:],
+        t.Key('role_name'): t.String,
+        }).ignore_extra('*')),
+    t.Key('disabled'): t.Bool(),
+    t.Key('is_superuser'): t.Bool(),
+}).ignore_extra('*')
+
+TrafaretRoleView = t.Dict({
+    t.Key('id'): t.Int[0:],
+    t.Key('role_name'): t.String,
+    t.Key('permissions'): t.List(t.Enum(*PERMISSIONS), min_length=1),
+    t.Key('description', default=''): t.String(allow_blank=True,
+                                               max_length=64)
+})
+
+
+def make_users(count):
+    return [{
+        'id': uid,
+        'login': 'user{}@example.com'.format(uid),
+        'password': 'pbkdf2_sha256$100000$salt$' + '0' * 64,
+        'salt': None,
+        'is_superuser': False,
+        'firstname': 'First{}'.format(uid),
+        'lastname': 'Last{}'.format(uid),
+        'disabled': False,
+        'fullname_search': 'first{0} last{0}'.format(uid),
+        'roles': [{'user_id': uid, 'id': 1, 'role_name': 'Managers'},
+                  {'user_id': uid, 'id': 2, 'role_name': 'Editors'}],
+    } for uid in range(count)]
+
+
+def make_roles(count):
+    return [{
+        'id': role_id,
+        'role_name': 'Role {}'.format(role_id),
+        'permissions': PERMISSIONS,
+        'description': 'Description',
+    } for role_id in range(count)]
+
+
+def measure(name, view, rows, repeat):
+    best = min(timeit.repeat(lambda: [view(row) for row in rows],
+                             number=1, repeat=repeat))
+    print('{:<20} {:>10.2f} ms {:>10.2f} us/row'.format(
+        name, best * 1000, best / len(rows) * 1e6))
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('-n', '--rows', type=int, default=10000,
+                    help='Rows per run (default `%(default)s`)')
+    ap.add_argument('-r', '--repeat', type=int, default=5,
+                    help='Runs, best one is reported (default `%(default)s`)')
+    options = ap.parse_args()
+
+    users = make_users(options.rows)
+    roles = make_roles(options.rows)
+    assert ([TrafaretUserView(user) for user in users[:10]] ==
+            [UserView(user) for user in users[:10]])
+    assert ([TrafaretRoleView(role) for role in roles[:10]] ==
+            [RoleView(role) for role in roles[:10]])
+
+    for kind, rows, old, new in [('users', users, TrafaretUserView, UserView),
+                                 ('roles', roles, TrafaretRoleView, RoleView)]:
+        slow = measure(kind + ' trafaret', old, rows, options.repeat)
+        fast = measure(kind + ' projection', new, rows, options.repeat)
+        print('{:<20} {:>10.1f}x'.format(kind + ' speedup', slow / fast))
+
+
+if __name__ == '__main__':
+    main()
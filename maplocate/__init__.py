@@ -1 +1,8 @@
+import os
+
 __version__ = '0.0.0'
+
+if os.environ.get('MAPLOCATE_IMPORT_TIME'):
+    # Installed before anything heavy is imported, see maplocate.startup
+    from maplocate.startup import import_timer
+    import_timer.install()
@@ -1,10 +1,10 @@
 import asyncio
-import aiopg
 import injections
 import logging
 import trafaret as t
 
-from maplocate.admin.permissions import AuthenticationPolicy
+from maplocate.pools import MonitoredPool
+from maplocate.admin.permissions import AuthenticationPolicy, PRINCIPAL_KEY
 from maplocate.admin.tokens import TokensManager
 from .exceptions import ObjectNotFound, PermissionDenied
 
@@ -17,52 +17,61 @@ class BaseHandler:
 
     permissions = injections.depends(AuthenticationPolicy)
     tokens = injections.depends(TokensManager)
-    postgres = injections.depends(aiopg.sa.Engine)
+    postgres = injections.depends(MonitoredPool)
 
     def __init__(self, loop):
         self._loop = loop
 
-    @asyncio.coroutine
     def auth_superadmin_session(self, request):
-        """Check super admin session and return it.
-        In case of missing token NoAccessTokenError will be raised.
-        In case of the invalid token InvalidAccessTokenError will be raised.
+        """Check super admin session and return its principal.
+        Raises PermissionDenied if admin is not a superuser.
         """
 
-        session = yield from self.tokens.get_admin_session(request)
-        is_superuser = yield from self.permissions.is_superuser(session['uid'])
-        if not is_superuser:
+        principal = self.get_principal(request)
+        if not principal.is_superuser:
             raise PermissionDenied(reason='Must be superadmin')
-        return session
+        return principal
 
-    @asyncio.coroutine
     def auth_admin_session(self, request, permission):
-        """Check specified permission for admin session and return it.
-        In case of missing token NoAccessTokenError will be raised.
-        In case of the invalid token InvalidAccessTokenError will be raised.
+        """Check specified permission for admin session and return its
+        principal.
         If permission is not granted than PermissionDenied will be raised.
         """
 
-        session = yield from self.tokens.get_admin_session(request)
-        user_id = session['uid']
-        yield from self.permissions.check_permission(user_id, permission)
-        return session
+        principal = self.get_principal(request)
+        principal.check_permission(permission)
+        return principal
 
-    @asyncio.coroutine
     def auth_user_session(self, user_id, request, permission):
-        session = yield from self.tokens.get_admin_session(request)
-        if session['uid'] != user_id:
-            yield from self.permissions.check(session['uid'], permission)
-        return session
+        """Same as auth_admin_session, but permission is not required if
+        admin accesses his own profile.
+        """
+
+        principal = self.get_principal(request)
+        if principal.uid != user_id:
+            principal.check_permission(permission)
+        return principal
+
+    def get_principal(self, request):
+        """Returns principal resolved by AuthMiddleware.
+        In case of missing token NoAccessTokenError is raised by middleware.
+        In case of the invalid token InvalidAccessTokenError is raised by
+        middleware.
+        """
+
+        principal = request.get(PRINCIPAL_KEY)
+        assert principal is not None, (
+            "AuthMiddleware does not handle {!r}".format(request.path))
+        return principal
 
     @asyncio.coroutine
-    def log_admin_action(self, request, session, form=""):
+    def log_admin_action(self, request, principal, form=""):
         """Log admin actions for create, update and delete operations"""
 
         actions_log.info(
             "Admin action: %s %s (UID=%s, email=%s) %r",
-            request.method, request.path, session['uid'],
-            session['username'], form)
+            request.method, request.path, principal.uid,
+            principal.username, form)
 
     def matchdict_get(self, request, key, traf=t.Int[1:]):
         """Extract info from request route."""
@@ -77,4 +86,4 @@ class BaseHandler:
             raise ObjectNotFound()
 
     def get_user_id(self, request):
-        return self._matchdict_get(request, 'uid')
+        return self.matchdict_get(request, 'uid')
@@ -0,0 +1,66 @@
+"""Small in-process caches used in front of Postgres and Redis."""
+import time
+from collections import OrderedDict
+
+__all__ = ['TTLCache']
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU mapping with per-entry time to live.
+
+    Entries older than `ttl` seconds are treated as missing. When the cache
+    is full the least recently used entry is evicted.
+
+    >>> cache = TTLCache(maxsize=2, ttl=60)
+    >>> cache.set('a', 1)
+    >>> cache.get('a')
+    1
+    >>> cache.get('b', 'default')
+    'default'
+    """
+
+    def __init__(self, *, maxsize=1024, ttl=60, timer=time):
+        assert maxsize > 0, maxsize
+        assert ttl > 0, ttl
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Used for entries expiration, may be replaced in tests.
+        self.timer = timer
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        try:
+            expires_on, value = self._data[key]
+        except KeyError:
+            return default
+        if expires_on <= self.timer.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (self.timer.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def items(self):
+        """Returns list of (key, value) pairs, expired ones included."""
+        return [(key, value) for key, (_, value) in self._data.items()]
+
+    def pop(self, key, default=None):
+        expires_on, value = self._data.pop(key, (None, default))
+        return value
+
+    def clear(self):
+        self._data.clear()
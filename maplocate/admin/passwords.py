@@ -0,0 +1,229 @@
+"""Password hashing.
+
+Hashes are stored in `password` column as self-describing
+`algorithm$params$salt$hexdigest` strings and `salt` column is NULL.
+Rows created before that keep salt in `salt` column and either bare
+SHA-512 hex digest or `algorithm$params$hexdigest` in `password` column;
+they are still verified and are converted by `embed_salt()`, stored
+ones by `embed_salts()` (``maplocate embed-password-salts``).
+"""
+import asyncio
+import binascii
+import concurrent.futures
+import hashlib
+import hmac
+
+import sqlalchemy as sa
+
+from .utils import calculate_hash, generate_salt
+
+__all__ = ['SHA512Hasher', 'PBKDF2Hasher', 'ScryptHasher', 'HASHERS',
+           'PasswordsManager', 'embed_salt', 'embed_salts']
+
+
+def embed_salt(encoded, salt):
+    """Converts hash stored along with separate salt into
+    self-describing form.
+    """
+    if '$' not in encoded:
+        encoded = SHA512Hasher.algorithm + '$' + encoded
+    head, digest = encoded.rsplit('$', 1)
+    return '{}${}${}'.format(head, salt, digest)
+
+
+# The same as embed_salt(), for batch of rows still having separate salt
+_EMBED_SALTS_QUERY = sa.text(r"""
+    UPDATE "user" SET
+        password = regexp_replace(
+            CASE WHEN strpos(password, '$') = 0
+                 THEN 'sha512$' || password
+                 ELSE password END,
+            '([^$]*)$', salt || '$\1'),
+        salt = NULL
+    WHERE id IN (SELECT id FROM "user"
+                 WHERE salt IS NOT NULL
+                 LIMIT :batch_size)
+""")
+
+
+@asyncio.coroutine
+def embed_salts(postgres, *, batch_size=1000):
+    """Moves separate salts of stored hashes into them in batches of
+    `batch_size` rows, returns number of converted rows. Each batch is
+    committed by itself, so it may run along with service.
+    """
+    converted = 0
+    while True:
+        with (yield from postgres) as pg_con:
+            result = yield from pg_con.execute(
+                _EMBED_SALTS_QUERY, batch_size=batch_size)
+        if not result.rowcount:
+            return converted
+        converted += result.rowcount
+
+
+class SHA512Hasher:
+    """Legacy salted SHA-512, only verified, never used for new hashes.
+    Format is `sha512$salt$hexdigest`.
+    """
+
+    algorithm = 'sha512'
+
+    def encode(self, password, salt):
+        return '{}${}${}'.format(self.algorithm, salt,
+                                 calculate_hash(password, salt))
+
+    def verify(self, password, encoded):
+        algorithm, salt, _ = encoded.split('$')
+        return hmac.compare_digest(self.encode(password, salt), encoded)
+
+    def needs_rehash(self, encoded):
+        return True
+
+
+class PBKDF2Hasher:
+    """Format is `pbkdf2_sha256$iterations$salt$hexdigest`."""
+
+    algorithm = 'pbkdf2_sha256'
+    digest = 'sha256'
+
+    def __init__(self, *, iterations=100000):
+        self.iterations = iterations
+
+    def encode(self, password, salt, iterations=None, dklen=None):
+        iterations = iterations or self.iterations
+        dk = hashlib.pbkdf2_hmac(self.digest, password.encode('utf-8'),
+                                 salt.encode('utf-8'), iterations, dklen)
+        return '{}${}${}${}'.format(self.algorithm, iterations, salt,
+                                    binascii.hexlify(dk).decode('ascii'))
+
+    def verify(self, password, encoded):
+        algorithm, iterations, salt, digest = encoded.split('$')
+        return hmac.compare_digest(
+            self.encode(password, salt, int(iterations), len(digest) // 2),
+            encoded)
+
+    def needs_rehash(self, encoded):
+        algorithm, iterations, _, _ = encoded.split('$')
+        return (algorithm != self.algorithm or
+                int(iterations) != self.iterations)
+
+
+class ScryptHasher:
+    """Memory-hard scrypt, requires Python 3.6+ built with OpenSSL 1.1+.
+    Format is `scrypt$n$r$p$salt$hexdigest`.
+    """
+
+    algorithm = 'scrypt'
+    dklen = 32
+
+    def __init__(self, *, n=16384, r=8, p=1):
+        if not hasattr(hashlib, 'scrypt'):
+            raise RuntimeError('hashlib.scrypt is not available')
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def encode(self, password, salt, n=None, r=None, p=None, dklen=None):
+        n, r, p = n or self.n, r or self.r, p or self.p
+        dk = hashlib.scrypt(password.encode('utf-8'),
+                            salt=salt.encode('utf-8'),
+                            n=n, r=r, p=p, dklen=dklen or self.dklen,
+                            maxmem=256 * n * r + 1024 ** 2)
+        return '{}${}${}${}${}${}'.format(
+            self.algorithm, n, r, p, salt,
+            binascii.hexlify(dk).decode('ascii'))
+
+    def verify(self, password, encoded):
+        algorithm, n, r, p, salt, digest = encoded.split('$')
+        return hmac.compare_digest(
+            self.encode(password, salt, int(n), int(r), int(p),
+                        len(digest) // 2),
+            encoded)
+
+    def needs_rehash(self, encoded):
+        algorithm, *params = encoded.split('$')[:4]
+        return (algorithm != self.algorithm or
+                list(map(int, params)) != [self.n, self.r, self.p])
+
+
+HASHERS = {hasher.algorithm: hasher
+           for hasher in (SHA512Hasher, PBKDF2Hasher, ScryptHasher)}
+
+
+class PasswordsManager:
+    """Hashes and verifies passwords in executor, so expensive key
+    derivation does not block event loop.
+
+    New hashes are made by `hasher`, hashes of other algorithms (and of
+    other cost parameters) are verified and reported as needing rehash.
+    At most `max_concurrency` hashes are calculated or queued in executor
+    at once, other callers wait their turn in the event loop.
+    """
+
+    def __init__(self, hasher, *, loop, executor=None, max_concurrency=8):
+        self.hasher = hasher
+        self._loop = loop
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_concurrency)
+        self._executor = executor
+        self._semaphore = asyncio.Semaphore(max_concurrency, loop=loop)
+        # Verifiers of other algorithms, created on demand
+        self._hashers = {hasher.algorithm: hasher}
+
+    @classmethod
+    def from_config(cls, config, *, loop):
+        if config['algorithm'] == ScryptHasher.algorithm:
+            hasher = ScryptHasher(**config['scrypt'])
+        else:
+            hasher = PBKDF2Hasher(iterations=config['pbkdf2_iterations'])
+        if config['executor'] == 'process':
+            executor = concurrent.futures.ProcessPoolExecutor(
+                config['workers'])
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                config['workers'])
+        return cls(hasher, loop=loop, executor=executor,
+                   max_concurrency=config['max_concurrency'])
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    @asyncio.coroutine
+    def hash(self, password):
+        """Returns self-describing hash of new password."""
+
+        return (yield from self._run(self.hasher.encode, password,
+                                     generate_salt()))
+
+    @asyncio.coroutine
+    def verify(self, password, encoded, salt=None):
+        """Returns (is valid, needs rehash) pair.
+        Pass `salt` column value for rows having separate salt.
+        """
+
+        if salt is not None:
+            encoded = embed_salt(encoded, salt)
+        hasher = self._get_hasher(encoded)
+        valid = yield from self._run(hasher.verify, password, encoded)
+        needs_rehash = (salt is not None or
+                        hasher is not self.hasher or
+                        self.hasher.needs_rehash(encoded))
+        return valid, valid and needs_rehash
+
+    def _get_hasher(self, encoded):
+        algorithm = encoded.partition('$')[0]
+        hasher = self._hashers.get(algorithm)
+        if hasher is None:
+            if algorithm not in HASHERS:
+                raise RuntimeError("Unknown password hash algorithm {!r}"
+                                   .format(algorithm))
+            # Cost parameters are taken from encoded hash while verifying
+            hasher = self._hashers[algorithm] = HASHERS[algorithm]()
+        return hasher
+
+    @asyncio.coroutine
+    def _run(self, func, *args):
+        with (yield from self._semaphore):
+            return (yield from self._loop.run_in_executor(
+                self._executor, func, *args))
@@ -1,15 +1,21 @@
 """Module holds user permissions"""
+import collections
 import enum
-import aiopg.sa
+import time
 import asyncio
 import injections
 import trafaret as t
-from sqlalchemy import select, join
+from sqlalchemy import text
 
-import maplocate.db.scheme as db
+from maplocate.db.queries import queries
+from maplocate.pools import MonitoredPool
+from .cache import TTLCache
 from .exceptions import PermissionDenied
+from .pubsub import ALL, Subscription, publish
+from .tokens import TokensManager
 
-__all__ = ['Permission', 'AuthenticationPolicy']
+__all__ = ['Permission', 'Principal', 'AuthenticationPolicy',
+           'AuthMiddleware', 'PRINCIPAL_KEY']
 
 
 class _EnumDict(enum._EnumDict):
@@ -80,25 +86,141 @@ class Permission(NamingEnum):
     def EnumTrafaret(cls):
         return t.Enum(*[p.value for p in cls])
 
+    @property
+    def bit(self):
+        return _PERMISSION_BITS[self.value]
+
+    @classmethod
+    def mask(cls, names):
+        """Compiles permission names into integer bitmask.
+        Unknown names (ie permissions removed from enum) are ignored.
+        """
+        mask = 0
+        for name in names:
+            mask |= _PERMISSION_BITS.get(name, 0)
+        return mask
+
+
+_PERMISSION_BITS = {perm.value: 1 << index
+                    for index, perm in enumerate(Permission)}
+
+
+class Principal(collections.namedtuple(
+        'Principal', 'uid username is_superuser permissions')):
+    """Authenticated admin with his permissions compiled into bitmask."""
+
+    __slots__ = ()
+
+    def has_permission(self, permission):
+        return (self.is_superuser or
+                bool(self.permissions & Permission(permission).bit))
+
+    def check_permission(self, permission):
+        """Raises PermissionDenied if principal has no permission."""
+        if not self.has_permission(permission):
+            raise PermissionDenied(permission=Permission(permission).name)
+
+
+# Request key of resolved Principal, see AuthMiddleware.
+PRINCIPAL_KEY = 'maplocate.principal'
+
+
+# Superuser flag and all distinct permissions of user's roles in one
+# round trip.
+_PRINCIPAL_QUERY = queries.register('principal', text("""
+    SELECT u.is_superuser,
+           ARRAY(SELECT DISTINCT unnest(r.permissions)
+                 FROM roles AS r
+                 JOIN user_roles AS ur ON ur.role_id = r.id
+                 WHERE ur.user_id = u.id) AS permissions
+    FROM "user" AS u
+    WHERE u.id = :user_id
+"""))
+
 
 @injections.has
 class AuthenticationPolicy:
-    """Class is used for user permissions checking"""
+    """Class is used for user permissions checking.
+
+    Resolved permissions are cached per worker for `cache_ttl` seconds.
+    Changes of users and roles must be announced with `invalidate()`, which
+    drops cached entries in every worker via Redis pub/sub.
+    """
 
-    postgres = injections.depends(aiopg.sa.Engine)
+    postgres = injections.depends(MonitoredPool)
+    redis = injections.depends(MonitoredPool)
 
-    def __init__(self):
-        self._superuser_query = select([db.user.c.is_superuser])
-        self._permission_query = select([db.roles]).select_from(
-            join(db.roles, db.user_roles,
-                 db.roles.c.id == db.user_roles.c.role_id))
+    INVALIDATE_CHANNEL = 'invalidate:permissions'
+
+    def __init__(self, *, loop, cache_size=1024, cache_ttl=60, timer=time):
+        self._loop = loop
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl, timer=timer)
+        # Bumped on every invalidation, so results fetched from Postgres
+        # concurrently with invalidation are not stored in the cache.
+        self._generation = 0
+        self._subscription = Subscription(
+            self.INVALIDATE_CHANNEL, self._on_invalidate, loop=loop)
 
     @asyncio.coroutine
-    def is_superuser(self, user_id):
+    def subscribe(self):
+        """Starts listening invalidations from other workers."""
+        yield from self._subscription.start(self.redis)
+
+    @asyncio.coroutine
+    def close(self):
+        yield from self._subscription.close()
+
+    @asyncio.coroutine
+    def invalidate(self, user_id=None):
+        """Drops cached permissions of user or of all users if user_id
+        is not passed (role changes affect everyone having the role).
+        """
+        message = ALL if user_id is None else str(user_id)
+        self._on_invalidate(message)
+        yield from publish(self.redis, self.INVALIDATE_CHANNEL, message)
+
+    def _on_invalidate(self, message):
+        self._generation += 1
+        if message == ALL:
+            self._cache.clear()
+        else:
+            self._cache.pop(int(message))
+
+    @asyncio.coroutine
+    def _get_permissions(self, user_id):
+        """Returns (is_superuser, permissions bitmask) pair for user."""
+
+        cached = self._cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        generation = self._generation
         with (yield from self.postgres) as conn:
-            is_superuser = yield from conn.scalar(
-                self._superuser_query.where(db.user.c.id == user_id))
-            return is_superuser
+            cursor = yield from _PRINCIPAL_QUERY.execute(conn,
+                                                         user_id=user_id)
+            row = yield from cursor.first()
+
+        if row is None:
+            resolved = (False, 0)
+        else:
+            resolved = (bool(row.is_superuser),
+                        Permission.mask(row.permissions))
+        if generation == self._generation:
+            self._cache.set(user_id, resolved)
+        return resolved
+
+    @asyncio.coroutine
+    def resolve_principal(self, session):
+        """Returns Principal for admin session."""
+
+        uid = session['uid']
+        is_superuser, permissions = yield from self._get_permissions(uid)
+        return Principal(uid, session['username'], is_superuser, permissions)
+
+    @asyncio.coroutine
+    def is_superuser(self, user_id):
+        is_superuser, _ = yield from self._get_permissions(user_id)
+        return is_superuser
 
     @asyncio.coroutine
     def check_permission(self, user_id, permission):
@@ -107,19 +229,35 @@ class AuthenticationPolicy:
         If user is a superuser - permissions are never checked.
         """
         permission = Permission(permission)
-        with (yield from self.postgres) as conn:
-            # check if user is superuser
-            is_super = yield from conn.scalar(
-                self._super_query.where(db.user.c.id == user_id))
-            if is_super:
-                return True
-
-            rows = yield from conn.execute(
-                self._permission_query
-                .where(db.user_roles.c.user_id == user_id))
-            for row in rows:
-                if permission.name in set(row['permissions']):
-                    break
-            else:
-                raise PermissionDenied(permission=permission.name)
-            return True
+        is_superuser, permissions = yield from self._get_permissions(user_id)
+        if not (is_superuser or permissions & permission.bit):
+            raise PermissionDenied(permission=permission.name)
+        return True
+
+
+@injections.has
+class AuthMiddleware:
+    """Middleware factory resolving admin principal once per request.
+
+    For every request with path starting with `prefix` token, session and
+    permissions are resolved before handler is called and Principal is
+    stored as `request[PRINCIPAL_KEY]`. NoAccessTokenError or
+    InvalidAccessTokenError is raised if request is not authenticated.
+    """
+
+    tokens = injections.depends(TokensManager)
+    permissions = injections.depends(AuthenticationPolicy)
+
+    def __init__(self, *, prefix='/admin/'):
+        self.prefix = prefix
+
+    @asyncio.coroutine
+    def __call__(self, app, handler):
+        @asyncio.coroutine
+        def middleware(request):
+            if request.path.startswith(self.prefix):
+                session = yield from self.tokens.get_admin_session(request)
+                request[PRINCIPAL_KEY] = (
+                    yield from self.permissions.resolve_principal(session))
+            return (yield from handler(request))
+        return middleware
@@ -0,0 +1,98 @@
+"""Cross-worker notifications over Redis pub/sub."""
+import asyncio
+import logging
+
+__all__ = ['Subscription', 'publish', 'ALL']
+
+
+log = logging.getLogger(__name__)
+
+# Message meaning "drop everything", also delivered locally when the
+# subscription connection is lost and some messages might be missed.
+ALL = '*'
+
+
+@asyncio.coroutine
+def publish(redis, channel, message):
+    """Publishes message to all subscribed workers."""
+
+    with (yield from redis) as conn:
+        yield from conn.publish(channel, message)
+
+
+class Subscription:
+    """Listens Redis channel and passes every message to callback.
+
+    Holds one connection from the pool while started. If connection is lost
+    callback receives `ALL` and subscription is re-established after
+    `retry_delay` seconds.
+    """
+
+    def __init__(self, channel, callback, *, loop, retry_delay=1.0):
+        self.channel = channel
+        self._callback = callback
+        self._loop = loop
+        self._retry_delay = retry_delay
+        self._task = None
+        self._redis = None
+        self._conn = None
+
+    @asyncio.coroutine
+    def start(self, redis):
+        assert self._task is None, "Subscription is already started"
+        self._redis = redis
+        channel = yield from self._subscribe()
+        self._task = asyncio.ensure_future(self._reader(channel),
+                                           loop=self._loop)
+
+    @asyncio.coroutine
+    def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            yield from self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        yield from self._release()
+
+    @asyncio.coroutine
+    def _subscribe(self):
+        self._conn = yield from self._redis.acquire()
+        channel, = yield from self._conn.subscribe(self.channel)
+        return channel
+
+    @asyncio.coroutine
+    def _release(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if not conn.closed:
+            try:
+                yield from conn.unsubscribe(self.channel)
+            except Exception:
+                conn.close()
+        self._redis.release(conn)
+
+    @asyncio.coroutine
+    def _reader(self, channel):
+        while True:
+            while (yield from channel.wait_message()):
+                message = yield from channel.get(encoding='utf-8')
+                self._callback(message)
+
+            log.warning("Lost subscription to %r, resubscribing",
+                        self.channel)
+            self._callback(ALL)
+            yield from self._release()
+            while True:
+                yield from asyncio.sleep(self._retry_delay, loop=self._loop)
+                try:
+                    channel = yield from self._subscribe()
+                except (OSError, ConnectionError):
+                    log.warning("Can not resubscribe to %r", self.channel,
+                                exc_info=True)
+                    yield from self._release()
+                else:
+                    break
@@ -1,14 +1,20 @@
 import injections
 import asyncio
-import aiopg
+import hashlib
+import json
 import psycopg2
 import trafaret as t
 
-from sqlalchemy import select, join
+import sqlalchemy as sa
+from sqlalchemy import select, join, text
 
 from maplocate.db import scheme as db
+from maplocate.db.queries import queries
+from maplocate.pools import MonitoredPool
 from .base import BaseHandler
-from .utils import validate, render_json
+from .utils import validate, render_json, check_etag
+from .serializers import renderer
+from .views import RoleView
 from .permissions import Permission
 from .exceptions import (ObjectAlreadyExist,
                          ObjectNotFound,
@@ -23,14 +29,6 @@ CreateRoleForm = t.Dict({
     t.Key('description', optional=True): t.String(max_length=64),
 })
 
-RoleView = t.Dict({
-    t.Key('id'): t.Int[0:],
-    t.Key('role_name'): t.String,
-    t.Key('permissions'): Permissions,
-    t.Key('description', default=''): t.String(allow_blank=True,
-                                               max_length=64)
-})
-
 UpdateRoleForm = t.Dict({
     t.Key('role_name', optional=True): t.String(max_length=64),
     t.Key('permissions', optional=True): Permissions,
@@ -39,17 +37,87 @@ UpdateRoleForm = t.Dict({
 
 UpdateUserRolesForm = t.List(t.Int)
 
+# JSON object keys are strings, t.Int converts them to user ids
+UpdateUsersRolesForm = t.Mapping(t.Int, UpdateUserRolesForm)
+
+
+# Makes roles of `users` to be exactly the (user_ids[i], role_ids[i]) pairs
+# if all role ids exist, returns non-existent role ids otherwise.
+# All CTEs see the same snapshot, so validation guards the changes.
+_SET_USERS_ROLES_QUERY = queries.register('set_users_roles', text("""
+    WITH wanted AS (
+        SELECT DISTINCT user_id, role_id
+        FROM unnest(CAST(:user_ids AS integer[]),
+                    CAST(:role_ids AS integer[])) AS w (user_id, role_id)
+    ), invalid AS (
+        SELECT DISTINCT w.role_id FROM wanted AS w
+        WHERE NOT EXISTS (SELECT 1 FROM roles AS r WHERE r.id = w.role_id)
+    ), deleted AS (
+        DELETE FROM user_roles AS ur
+        WHERE ur.user_id = ANY (CAST(:users AS integer[]))
+          AND NOT EXISTS (SELECT 1 FROM invalid)
+          AND NOT EXISTS (SELECT 1 FROM wanted AS w
+                          WHERE w.user_id = ur.user_id
+                            AND w.role_id = ur.role_id)
+    ), inserted AS (
+        INSERT INTO user_roles (user_id, role_id)
+        SELECT user_id, role_id FROM wanted
+        WHERE NOT EXISTS (SELECT 1 FROM invalid)
+        ON CONFLICT DO NOTHING
+    )
+    SELECT role_id FROM invalid ORDER BY role_id
+"""))
+
+
+PERMISSION_GROUPS = {
+    'roles': 'Admin role actions',
+    'users': 'Admin user actions'
+}
+
+
+def _list_permissions():
+    grouped_permissions = []
+
+    for perm in Permission:
+        prefix, *tail = perm.value.split('_')
+        group = PERMISSION_GROUPS.get(prefix, prefix.title())
+        grouped_permissions.append((perm, group))
+
+    return [
+        {'id': perm.name, 'group': group, 'description': perm.description}
+        for perm, group in grouped_permissions]
+
+
+# Permissions depend on Permission enum only, so are listed once.
+# ETags are weak, as bodies are the same JSON but may be gzipped or not.
+PERMISSIONS_LIST = _list_permissions()
+PERMISSIONS_ETAG = 'W/"permissions-{}"'.format(hashlib.sha1(
+    json.dumps(PERMISSIONS_LIST, sort_keys=True).encode('utf-8')
+).hexdigest())
+
 
 @injections.has
 class RolesHandler(BaseHandler):
     """Roles and permissions handler."""
 
-    postgres = injections.depends(aiopg.sa.Engine)
+    postgres = injections.depends(MonitoredPool)
+
+    # Bumped by trigger on every change of roles table
+    _roles_version_query = queries.register(
+        'roles_version',
+        select([db.table_versions.c.version])
+        .where(db.table_versions.c.table_name == db.roles.name))
+
+    _role_query = queries.register(
+        'role_by_id',
+        db.roles.select().where(db.roles.c.id == sa.bindparam('role_id')))
 
-    PERMISSION_GROUPS = {
-        'roles': 'Admin role actions',
-        'users': 'Admin user actions'
-    }
+    _user_roles_query = queries.register('user_roles', select([
+        db.roles,
+    ]).select_from(
+        join(db.roles, db.user_roles,
+             db.roles.c.id == db.user_roles.c.role_id)
+    ).where(db.user_roles.c.user_id == sa.bindparam('user_id')))
 
     @validate(CreateRoleForm)
     @asyncio.coroutine
@@ -58,8 +126,8 @@ class RolesHandler(BaseHandler):
         Request: 'POST', '/admin/roles'
         """
 
-        session = yield from self.auth_admin_session(request,
-                                                     Permission.roles_edit)
+        principal = self.auth_admin_session(
+            request, Permission.roles_edit)
         with (yield from self.postgres) as pg_con:
             transaction = yield from pg_con.begin()
             try:
@@ -81,9 +149,9 @@ class RolesHandler(BaseHandler):
                 yield from transaction.rollback()
                 raise
 
-        yield from self.log_admin_action(request, session, form)
+        yield from self.log_admin_action(request, principal, form)
 
-        return RoleView(dict(row))
+        return RoleView(row)
 
     @render_json
     @asyncio.coroutine
@@ -92,14 +160,18 @@ class RolesHandler(BaseHandler):
         Request: 'GET', '/admin/roles/{role_id}'
         """
 
-        yield from self.auth_admin_session(request, Permission.roles_view)
+        self.auth_admin_session(request, Permission.roles_view)
         role_id = self._get_role_id(request)
         with (yield from self.postgres) as pg_con:
-            cursor = yield from pg_con.execute(
-                db.roles.select()
-                .where(db.roles.c.id == role_id))
+            version = yield from self._get_roles_version(pg_con)
+            etag = 'W/"roles-{}-{}"'.format(version, role_id)
+            check_etag(request, etag)
+            cursor = yield from self._role_query.execute(
+                pg_con, role_id=role_id)
             row = yield from cursor.first()
-        return RoleView(dict(row))
+        if row is None:
+            raise ObjectNotFound()
+        return renderer.response(RoleView(row), etag=etag)
 
     @validate(UpdateRoleForm)
     @asyncio.coroutine
@@ -108,8 +180,8 @@ class RolesHandler(BaseHandler):
         Request: 'PATCH', '/admin/roles/{role_id}'
         """
 
-        session = yield from self.auth_admin_session(request,
-                                                     Permission.roles_edit)
+        principal = self.auth_admin_session(
+            request, Permission.roles_edit)
         role_id = self._get_role_id(request)
         updated_role = {}
         with (yield from self.postgres) as pg_con:
@@ -132,9 +204,12 @@ class RolesHandler(BaseHandler):
             except psycopg2.IntegrityError:
                 raise JsonBodyValidationError()
 
-        yield from self.log_admin_action(request, session, form)
+        if 'permissions' in form:
+            yield from self.permissions.invalidate()
+
+        yield from self.log_admin_action(request, principal, form)
 
-        return RoleView(dict(updated_role))
+        return RoleView(updated_role)
 
     @render_json
     @asyncio.coroutine
@@ -143,8 +218,8 @@ class RolesHandler(BaseHandler):
         Request: 'DELETE', '/admin/roles/{role_id}'
         """
 
-        session = yield from self.auth_admin_session(request,
-                                                     Permission.roles_edit)
+        principal = self.auth_admin_session(
+            request, Permission.roles_edit)
         role_id = self._get_role_id(request)
         deleted_roles_amount = None
 
@@ -161,7 +236,9 @@ class RolesHandler(BaseHandler):
             raise ObjectNotFound()
         assert deleted_roles_amount == 1
 
-        yield from self.log_admin_action(request, session)
+        yield from self.permissions.invalidate()
+
+        yield from self.log_admin_action(request, principal)
 
         return {'status': 'deleted'}
 
@@ -172,28 +249,24 @@ class RolesHandler(BaseHandler):
         Request: 'GET', '/admin/roles/'
         """
 
-        yield from self.auth_admin_session(request, Permission.roles_view)
+        self.auth_admin_session(request, Permission.roles_view)
         with (yield from self.postgres) as pg_con:
-            result = yield from pg_con.execute(db.roles.select())
-        return [RoleView(dict(row)) for row in result]
+            version = yield from self._get_roles_version(pg_con)
+            etag = 'W/"roles-{}"'.format(version)
+            check_etag(request, etag)
+            cursor = yield from pg_con.execute(db.roles.select())
+            rows = yield from cursor.fetchall()
+        return renderer.response([RoleView(row) for row in rows], etag=etag)
 
     @render_json
     @asyncio.coroutine
-    def list_permissions(self):
+    def list_permissions(self, request):
         """List all system permissions.
         Request: 'GET', '/admin/permissions
         """
 
-        grouped_permissions = []
-
-        for perm in Permission:
-            prefix, *tail = perm.value.split('_')
-            group = self.PERMISSION_GROUPS.get(prefix, prefix.title())
-            grouped_permissions.append((perm, group))
-
-        return [
-            {'id': perm.name, 'group': group, 'description': perm.description}
-            for perm, group in grouped_permissions]
+        check_etag(request, PERMISSIONS_ETAG)
+        return renderer.response(PERMISSIONS_LIST, etag=PERMISSIONS_ETAG)
 
     @render_json
     @asyncio.coroutine
@@ -202,12 +275,10 @@ class RolesHandler(BaseHandler):
         Request: 'GET', '/admin/users/{uid}/roles'
         """
 
-        session = yield from self.tokens.get_admin_session(request)
         user_id = self.get_user_id(request)
-        if session['uid'] != user_id:
-            yield from self.auth_admin_session(request, Permission.users_view)
+        self.auth_user_session(user_id, request, Permission.users_view)
         user_roles = yield from self._get_user_roles(user_id)
-        return [RoleView(dict(role)) for role in user_roles]
+        return [RoleView(role) for role in user_roles]
 
     @validate(UpdateUserRolesForm, as_param='lst')
     @asyncio.coroutine
@@ -216,103 +287,91 @@ class RolesHandler(BaseHandler):
         Request: 'PUT', '/admin/users/{uid}/roles'
         """
 
-        session = yield from self.auth_admin_session(
+        principal = self.auth_admin_session(
             request, Permission.users_roles_edit)
         user_id = self.get_user_id(request)
 
-        if len(lst) != len(set(lst)):
-            raise JsonBodyValidationError(fields={
-                'roles': 'Duplicates in user roles list'
-            })
+        yield from self._set_users_roles({user_id: lst})
+
+        yield from self.permissions.invalidate(user_id)
+        roles = yield from self._get_user_roles(user_id)
+
+        yield from self.log_admin_action(request, principal, lst)
+
+        return [RoleView(rec) for rec in roles]
+
+    @validate(UpdateUsersRolesForm, as_param='users_roles')
+    @asyncio.coroutine
+    def update_users_roles(self, request, users_roles):
+        """Update roles of many users at once.
+        Request: 'PUT', '/admin/users/roles'
+        """
+
+        principal = self.auth_admin_session(
+            request, Permission.users_roles_edit)
+
+        yield from self._set_users_roles(users_roles)
 
+        yield from self.permissions.invalidate()
         with (yield from self.postgres) as pg_con:
-            transaction = yield from pg_con.begin()
-            try:
-                yield from pg_con.execute(
-                    """
-                    CREATE TEMP TABLE user_roles_temp (
-                    LIKE user_roles INCLUDING DEFAULTS
-                    INCLUDING CONSTRAINTS
-                    INCLUDING INDEXES)
-                    """)
-
-                user_roles_list = ','.join(
-                    '({}, {})'.format(user_id, _) for _ in lst)
-                if user_roles_list:
-                    yield from pg_con.execute(
-                        """
-                        INSERT INTO user_roles_temp (user_id, role_id)
-                        VALUES {};
-                        """.format(user_roles_list))
-
-                result = yield from pg_con.execute(
-                    """
-                    SELECT * FROM roles WHERE id IN
-                    (SELECT role_id FROM user_roles_temp WHERE
-                                        user_id={userid})
-                    """.format(userid=user_id))
-
-                if result.rowcount != len(lst):
-                    yield from transaction.rollback()
-                    valid_ids = [rec.id for rec in result.fetchall()]
-                    invalid_ids = list(set(lst) - set(valid_ids))
-                    raise JsonBodyValidationError(fields={
-                        'roles': "Received invalid ids: {}".format(
-                            invalid_ids
-                        )
-                    })
-
-                where_non_actual_roles = """
-                    WHERE ur.user_id={userid} AND
-                    r.id = ur.role_id AND
-                    ur.role_id NOT IN
-                    (SELECT role_id FROM user_roles_temp WHERE
-                    user_id={userid})
-                    """.format(userid=user_id)
-
-                # drop non actual roles
-                yield from pg_con.execute("""
-                    DELETE FROM user_roles as ur USING roles as r
-                    """ + where_non_actual_roles)
-
-                # drop already in list roles
-                yield from pg_con.execute(
-                    """
-                    DELETE FROM user_roles_temp as t USING user_roles as ur
-                    WHERE t.user_id = ur.user_id AND ur.role_id = t.role_id
-                    """)
-
-                # insert roles
-                yield from pg_con.execute(
-                    """
-                    INSERT INTO user_roles (user_id, role_id)
-                    SELECT user_id, role_id
-                    FROM user_roles_temp
-                    """)
-
-                yield from pg_con.execute("DROP TABLE user_roles_temp;")
+            cursor = yield from pg_con.execute(
+                select([db.user_roles.c.user_id, db.roles])
+                .select_from(join(db.roles, db.user_roles,
+                                  db.roles.c.id == db.user_roles.c.role_id))
+                .where(db.user_roles.c.user_id.in_(list(users_roles)))
+                .order_by(db.user_roles.c.user_id))
+            rows = yield from cursor.fetchall()
 
-            except psycopg2.IntegrityError:
-                yield from transaction.rollback()
-                raise JsonBodyValidationError()
-            else:
-                yield from transaction.commit()
-        roles = yield from self._get_user_roles(user_id)
+        result = {str(user_id): [] for user_id in users_roles}
+        for row in rows:
+            result[str(row.user_id)].append(RoleView(row))
 
-        yield from self.log_admin_action(request, session, lst)
+        yield from self.log_admin_action(request, principal, users_roles)
 
-        return [RoleView(dict(rec)) for rec in roles]
+        return result
 
     def _get_role_id(self, request):
         return self.matchdict_get(request, 'role_id')
 
     @asyncio.coroutine
-    def _get_user_roles(self, user_id):
-        perm_query = select([db.roles]).select_from(
-            join(db.roles, db.user_roles,
-                 db.roles.c.id == db.user_roles.c.role_id))
+    def _get_roles_version(self, pg_con):
+        cursor = yield from self._roles_version_query.execute(pg_con)
+        return (yield from cursor.scalar()) or 0
+
+    @asyncio.coroutine
+    def _set_users_roles(self, users_roles):
+        """Replaces roles of users by mapping {user_id: [role_id, ...]} in one
+        statement. Raises JsonBodyValidationError if there are duplicated
+        or non-existent roles, nothing is changed then.
+        """
+
+        user_ids, role_ids = [], []
+        for user_id, roles in users_roles.items():
+            if len(roles) != len(set(roles)):
+                raise JsonBodyValidationError(fields={
+                    'roles': 'Duplicates in user roles list'
+                })
+            user_ids.extend([user_id] * len(roles))
+            role_ids.extend(roles)
+
+        with (yield from self.postgres) as pg_con:
+            try:
+                cursor = yield from _SET_USERS_ROLES_QUERY.execute(
+                    pg_con, users=list(users_roles), user_ids=user_ids,
+                    role_ids=role_ids)
+                invalid_ids = [row.role_id
+                               for row in (yield from cursor.fetchall())]
+            except psycopg2.IntegrityError:
+                raise JsonBodyValidationError()
+
+        if invalid_ids:
+            raise JsonBodyValidationError(fields={
+                'roles': "Received invalid ids: {}".format(invalid_ids)
+            })
 
+    @asyncio.coroutine
+    def _get_user_roles(self, user_id):
         with (yield from self.postgres) as pg_con:
-            user_roles = yield from pg_con.execute(
-                perm_query.where(db.user_roles.c.user_id == user_id))
-        return user_roles
+            cursor = yield from self._user_roles_query.execute(
+                pg_con, user_id=user_id)
+            return (yield from cursor.fetchall())
@@ -8,6 +8,7 @@ def setup_routes(app, users_handler, roles_handler):
 
     # user crud
     add_route('POST', '/admin/users/', users_handler.user_create)
+    add_route('POST', '/admin/users/bulk', users_handler.users_import)
     add_route('GET', '/admin/users/{uid}', users_handler.user_details)
     add_route('PATCH', '/admin/users/{uid}', users_handler.user_update)
     add_route('DELETE', '/admin/users/{uid}', users_handler.user_delete)
@@ -24,6 +25,7 @@ def setup_routes(app, users_handler, roles_handler):
     add_route('GET', '/admin/permissions', roles_handler.list_permissions)
 
     # user roles
+    add_route('PUT', '/admin/users/roles', roles_handler.update_users_roles)
     add_route('GET', '/admin/users/{uid}/roles', roles_handler.get_user_roles)
     add_route('PUT', '/admin/users/{uid}/roles',
               roles_handler.update_user_roles)
@@ -0,0 +1,159 @@
+"""JSON rendering of handler results.
+
+Objects are encoded straight into UTF-8 bytes by the fastest importable
+encoder (see ENCODERS) or by the one set in config. Responses larger than
+`compress_min_size` bytes are compressed with gzip or deflate if client
+accepts them. Encoding time is accounted to request metrics.
+"""
+import asyncio
+import collections
+import json
+import time
+
+from aiohttp import web
+
+from maplocate.metrics import metrics
+
+__all__ = ['ENCODERS', 'get_encoder', 'JSONRenderer', 'JSONArrayWriter',
+           'renderer']
+
+
+def _load_orjson():
+    import orjson
+    return orjson.dumps
+
+
+def _load_ujson():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False,
+                           escape_forward_slashes=False).encode('utf-8')
+    return dumps
+
+
+def _load_rapidjson():
+    import rapidjson
+
+    def dumps(obj):
+        return rapidjson.dumps(obj, ensure_ascii=False).encode('utf-8')
+    return dumps
+
+
+def _load_json():
+    encode = json.JSONEncoder(ensure_ascii=False,
+                              separators=(',', ':')).encode
+
+    def dumps(obj):
+        return encode(obj).encode('utf-8')
+    return dumps
+
+
+# Encoders in order of preference, each loader returns function encoding
+# object to bytes or raises ImportError.
+ENCODERS = collections.OrderedDict([
+    ('orjson', _load_orjson),
+    ('ujson', _load_ujson),
+    ('rapidjson', _load_rapidjson),
+    ('json', _load_json),
+])
+
+
+def get_encoder(name='auto'):
+    """Returns (name, dumps) of encoder, the first importable one
+    for 'auto'. Raises ImportError if requested encoder is not installed.
+    """
+    if name != 'auto':
+        return name, ENCODERS[name]()
+    for name, load in ENCODERS.items():
+        try:
+            return name, load()
+        except ImportError:
+            pass
+    raise AssertionError("stdlib json is always importable")
+
+
+class JSONRenderer:
+    """Makes JSON responses of handler results."""
+
+    def __init__(self, encoder='auto', *, compress_min_size=None):
+        self.configure(encoder, compress_min_size=compress_min_size)
+
+    def configure(self, encoder='auto', *, compress_min_size=None):
+        self.encoder, self.dumps = get_encoder(encoder)
+        self.compress_min_size = compress_min_size
+
+    def response(self, data, *, status=200, etag=None):
+        """Returns web.Response with encoded data.
+        Raises TypeError if data is not serializable.
+        """
+        started = time.perf_counter()
+        body = self.dumps(data)
+        metrics.record('serialization', time.perf_counter() - started)
+        response = web.Response(body=body, status=status,
+                                content_type='application/json')
+        if etag is not None:
+            response.headers['ETag'] = etag
+        if (self.compress_min_size is not None and
+                len(body) >= self.compress_min_size):
+            # Coding is negotiated from Accept-Encoding on prepare
+            response.enable_compression()
+            response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    @asyncio.coroutine
+    def stream_response(self, request, content_type='application/json'):
+        """Returns prepared StreamResponse, compressed if enabled, as
+        streamed responses are supposed to be large.
+        """
+        response = web.StreamResponse()
+        response.content_type = content_type
+        if self.compress_min_size is not None:
+            response.enable_compression()
+            response.headers['Vary'] = 'Accept-Encoding'
+        yield from response.prepare(request)
+        return response
+
+
+class JSONArrayWriter:
+    """Writes JSON array to prepared StreamResponse item by item.
+    Encoded items are buffered and sent by `flush()` in chunks of
+    about `buffer_size` bytes.
+    """
+
+    def __init__(self, response, *, dumps, buffer_size=64 * 1024):
+        self._response = response
+        self._dumps = dumps
+        self._buffer_size = buffer_size
+        self._buffer = [b'[']
+        self._buffered = 1
+        self._empty = True
+
+    def write(self, item):
+        if not self._empty:
+            self._buffer.append(b',')
+        self._empty = False
+        started = time.perf_counter()
+        data = self._dumps(item)
+        metrics.record('serialization', time.perf_counter() - started)
+        self._buffer.append(data)
+        self._buffered += len(data) + 1
+
+    @asyncio.coroutine
+    def flush(self, force=False):
+        """Sends buffered data if there is enough of it."""
+        if self._buffer and (force or self._buffered >= self._buffer_size):
+            self._response.write(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+            yield from self._response.drain()
+
+    @asyncio.coroutine
+    def close(self):
+        """Closes array and sends the rest of it."""
+        self._buffer.append(b']')
+        yield from self.flush(force=True)
+
+
+# Configured on startup, see maplocate.main
+renderer = JSONRenderer()
@@ -3,50 +3,116 @@ import json
 import uuid
 import time
 import logging
-import aioredis
 import injections
+import msgpack
 import trafaret as t
 
+from maplocate.pools import MonitoredPool
+from .cache import TTLCache
 from .exceptions import NoAccessTokenError, InvalidAccessTokenError
+from .pubsub import ALL, Subscription, publish
 
 
 log = logging.getLogger(__name__)
 
+# Sessions are stored as version byte followed by msgpack array of session
+# fields. Sessions stored as JSON objects start with b'{'.
+SESSION_V1 = b'\x01'
+
+
+def pack_session(session, fields):
+    """Packs session fields into compact binary form."""
+    return SESSION_V1 + msgpack.packb([session[name] for name in fields],
+                                      use_bin_type=True)
+
+
+def unpack_session(packed, fields, trafaret):
+    """Unpacks session written by pack_session or legacy JSON session.
+    Binary sessions are validated on write, so only legacy ones are checked
+    by trafaret.
+    Raises ValueError if data is malformed.
+    """
+    if packed[:1] == SESSION_V1:
+        values = msgpack.unpackb(packed[1:], encoding='utf-8')
+        if not isinstance(values, list) or len(values) != len(fields):
+            raise ValueError("Unexpected session fields")
+        return dict(zip(fields, values))
+    return trafaret(json.loads(packed.decode('utf-8')))
+
 
 @injections.has
 class TokensManager:
     """Access tokens manager.
     Generate new token, store and get sessions from Redis.
+
+    If `cache_size` is passed admin sessions are also cached per worker for
+    at most `cache_ttl` seconds. Invalidated sessions are dropped from
+    caches of all workers via Redis pub/sub.
     """
 
-    redis = injections.depends(aioredis.RedisPool)
+    redis = injections.depends(MonitoredPool)
 
     ADMIN_TOKEN_PREFIX = 'tokens:admin:{token}'
     ADMIN_TTL = 86400 * 3  # 3 days
-    ADMIN_INDEX_PREFIX = 'index:admin'
+    # Sorted set of user's tokens scored by expiration time
+    ADMIN_INDEX_PREFIX = 'index:admin:{uid}'
+    # Global index of "uid:token" members used before, see
+    # split_admin_index()
+    LEGACY_ADMIN_INDEX = 'index:admin'
+    INVALIDATE_CHANNEL = 'invalidate:sessions:admin'
 
     admin_session = t.Dict({
         t.Key('uid'): t.Int[0:],
         t.Key('username'): t.String(max_length=64),
     })
+    admin_session_fields = ('uid', 'username')
 
     @staticmethod
     def make_access_token():
         return uuid.uuid4().hex
 
-    def __init__(self, *, loop, timer=time):
+    def __init__(self, *, loop, timer=time, cache_size=None, cache_ttl=5):
         self._loop = loop
         # Used for last session operation monitoring.
         self.timer = timer
+        self._cache = None
+        self._subscription = None
+        # Bumped on every invalidation, see AuthenticationPolicy
+        self._generation = 0
+        if cache_size:
+            self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl,
+                                   timer=timer)
+            self._subscription = Subscription(
+                self.INVALIDATE_CHANNEL, self._on_invalidate, loop=loop)
+
+    @asyncio.coroutine
+    def subscribe(self):
+        """Starts listening invalidations from other workers."""
+        if self._subscription is not None:
+            yield from self._subscription.start(self.redis)
+
+    @asyncio.coroutine
+    def close(self):
+        if self._subscription is not None:
+            yield from self._subscription.close()
 
     @asyncio.coroutine
     def get_admin_session(self, request):
         """Returns admin session identified by access token."""
 
         token = self._get_token(request)
-        return (yield from self._get_session(
+        if self._cache is not None:
+            session = self._cache.get(token)
+            if session is not None:
+                return session
+
+        generation = self._generation
+        session = yield from self._get_session(
             self.ADMIN_TOKEN_PREFIX.format(token=token),
-            self.admin_session))
+            self.admin_session_fields, self.admin_session)
+        if self._cache is not None and generation == self._generation:
+            self._cache.set(token, session)
+        return session
 
     @asyncio.coroutine
     def set_admin_session(self, token, session):
@@ -54,14 +120,27 @@ class TokensManager:
         session = self.admin_session(session)
         yield from self._set_session(
             self.ADMIN_TOKEN_PREFIX.format(token=token),
-            session, ttl=self.ADMIN_TTL)
-        yield from self._index_session(
-            self.ADMIN_INDEX_PREFIX, session['uid'], token, ttl=self.ADMIN_TTL)
+            pack_session(session, self.admin_session_fields),
+            self.ADMIN_INDEX_PREFIX.format(uid=session['uid']), token,
+            ttl=self.ADMIN_TTL)
 
     @asyncio.coroutine
     def invalidate_admin_session(self, uid):
-        yield from self._invalidate_session(self.ADMIN_INDEX_PREFIX, uid,
-                                            self.ADMIN_TOKEN_PREFIX)
+        yield from self._invalidate_session(
+            self.ADMIN_INDEX_PREFIX.format(uid=uid), self.ADMIN_TOKEN_PREFIX)
+        if self._cache is not None:
+            self._on_invalidate(str(uid))
+            yield from publish(self.redis, self.INVALIDATE_CHANNEL, str(uid))
+
+    def _on_invalidate(self, message):
+        self._generation += 1
+        if message == ALL:
+            self._cache.clear()
+            return
+        uid = int(message)
+        for token, session in self._cache.items():
+            if session['uid'] == uid:
+                self._cache.pop(token)
 
     def _get_token(self, request):
         """Extracts AUTHORIZATION token from request header.
@@ -74,52 +153,91 @@ class TokensManager:
         return token
 
     @asyncio.coroutine
-    def _get_session(self, key, trafaret):
+    def _get_session(self, key, fields, trafaret):
         """Get session data from Redis identified by key.
         Raises InvalidAccessTokenError if session data not found.
         """
 
         with (yield from self.redis) as conn:
-            packed = yield from conn.get(key, encoding='utf-8')
+            packed = yield from conn.get(key)
         if not packed:
             raise InvalidAccessTokenError()
         try:
-            data = json.loads(packed)
-            return trafaret(data)
-        except ValueError:
+            return unpack_session(packed, fields, trafaret)
+        except (ValueError, TypeError):
             log.warning("Bad data found in session: %r", packed, exc_info=True)
             raise InvalidAccessTokenError()
 
     @asyncio.coroutine
-    def _set_session(self, key, value, *, ttl=0):
-        """Packs and stores session data in Redis."""
+    def _set_session(self, key, packed, index_key, token, *, ttl=0):
+        """Stores packed session data in Redis, adds token to user's index
+        and prunes expired tokens from it in one transaction.
+        """
 
+        now = self.timer.time()
+        expires_on = now + ttl if ttl > 0 else float('inf')
         with (yield from self.redis) as conn:
-            yield from conn.set(key, json.dumps(value), expire=ttl)
+            tr = conn.multi_exec()
+            tr.set(key, packed, expire=ttl)
+            tr.zremrangebyscore(index_key, max=now)
+            tr.zadd(index_key, expires_on, token)
+            if ttl > 0:
+                # Index lives no longer than the newest token
+                tr.expire(index_key, ttl)
+            yield from tr.execute()
 
     @asyncio.coroutine
-    def _index_session(self, index_key, uid, token, *, ttl=0):
+    def _invalidate_session(self, index_key, token_format):
+        """Deletes all sessions of user's index and index itself."""
+
         with (yield from self.redis) as conn:
-            expires_on = self.timer.time()+ttl if ttl > 0 else float('inf')
-            yield from conn.zadd(index_key, expires_on,
-                                 "{}:{}".format(uid, token))
+            yield from conn.eval(
+                self.INVALIDATE_SCRIPT, keys=[index_key],
+                args=[token_format.format(token='')])
+
+    # Deletes tokens listed in index KEYS[1], ARGV[1] is tokens key prefix
+    INVALIDATE_SCRIPT = """
+        local tokens = redis.call('ZRANGE', KEYS[1], 0, -1)
+        for _, token in ipairs(tokens) do
+            redis.call('DEL', ARGV[1] .. token)
+        end
+        redis.call('DEL', KEYS[1])
+        return #tokens
+    """
 
     @asyncio.coroutine
-    def _invalidate_session(self, index_key, uid, token_format):
+    def split_index(self, legacy_key, index_format, *, ttl, batch=1000):
+        """Moves "uid:token" members of global legacy index into per-user
+        indexes, skipping expired ones, then deletes legacy index.
+        `ttl` must be not less than lifetime of any token.
+        Returns number of moved tokens.
+        """
 
+        moved = 0
         with (yield from self.redis) as conn:
-            values = []
             cursor = b'0'
             while cursor:
-                # Return portions of sorted set and collect them in values
                 cursor, buffer = yield from conn.zscan(
-                    index_key, cursor, match="{}:*".format(uid))
-                values.extend([val for val in buffer[::2]])
+                    legacy_key, cursor, count=batch)
+                now = self.timer.time()
+                pipe = conn.pipeline()
+                index_keys = set()
+                for value, score in zip(buffer[::2], buffer[1::2]):
+                    if float(score) <= now:
+                        continue
+                    uid, _, token = value.decode('utf-8').partition(':')
+                    index_key = index_format.format(uid=uid)
+                    pipe.zadd(index_key, float(score), token)
+                    index_keys.add(index_key)
+                    moved += 1
+                for index_key in index_keys:
+                    pipe.expire(index_key, ttl)
+                yield from pipe.execute()
+            yield from conn.delete(legacy_key)
+        return moved
 
-            for value in values:
-                token = value[value.find(b':')+1:]
-                yield from conn.delete(
-                    token_format.format(token=token.decode('utf-8')))
-
-            if values:
-                yield from conn.zrem(index_key, *values)
+    @asyncio.coroutine
+    def split_admin_index(self):
+        return (yield from self.split_index(
+            self.LEGACY_ADMIN_INDEX, self.ADMIN_INDEX_PREFIX,
+            ttl=self.ADMIN_TTL))
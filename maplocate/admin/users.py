@@ -1,18 +1,26 @@
 import asyncio
+import base64
+import csv
 import injections
+import json
 import psycopg2
 import itertools
 
 import trafaret as t
 
-from aiohttp_jinja2 import template
-from sqlalchemy import select
-from sqlalchemy.sql import or_
+import sqlalchemy as sa
+from sqlalchemy import select, text, tuple_
+from sqlalchemy.dialects import postgresql
 
 from maplocate.db import scheme as db
+from maplocate.db.queries import queries
+from maplocate.db.search import user_fullname_filter, user_email_filter
 from maplocate import __version__
 from .base import BaseHandler
-from .utils import validate, generate_salt, calculate_hash, render_json
+from .utils import validate, render_json, render_template
+from .serializers import JSONArrayWriter, renderer
+from .views import UserView
+from .passwords import PasswordsManager
 from .permissions import Permission
 from .exceptions import (ObjectAlreadyExist, InvalidLogin, UserDisabled,
                          ObjectNotFound, JsonBodyValidationError,
@@ -35,18 +43,31 @@ CreateUserForm = t.Dict({
 })
 
 
-UserView = t.Dict({
-    t.Key('id') >> 'uid': t.Int[0:],
-    t.Key('login'): t.String,
-    t.Key('firstname', default=''): t.String(allow_blank=True, max_length=64),
-    t.Key('lastname', default=''): t.String(allow_blank=True, max_length=64),
-    t.Key('roles', default=list): t.List(t.Dict({
-        t.Key('id'): t.Int[0:],
-        t.Key('role_name'): t.String,
-        }).ignore_extra('*')),
-    t.Key('disabled'): t.Bool(),
-    t.Key('is_superuser'): t.Bool(),
-}).ignore_extra('*')
+# Rows validated, hashed and inserted at once by bulk import
+USERS_IMPORT_BATCH = 500
+USERS_IMPORT_CSV_BOOLS = {'': False, '0': False, 'false': False,
+                          '1': True, 'true': True}
+
+# Inserts batch of users passed as arrays of column values, skips
+# existing logins, salt is embedded in password hash
+_IMPORT_USERS_QUERY = text("""
+    INSERT INTO "user" (login, password, firstname, lastname,
+                        disabled, is_superuser)
+    SELECT * FROM unnest(CAST(:login AS varchar[]),
+                         CAST(:password AS text[]),
+                         CAST(:firstname AS varchar[]),
+                         CAST(:lastname AS varchar[]),
+                         CAST(:disabled AS boolean[]),
+                         CAST(:is_superuser AS boolean[]))
+    ON CONFLICT (login) DO NOTHING
+    RETURNING id, login
+""")
+
+
+USERS_PAGE_SIZE = 100
+USERS_MAX_PAGE_SIZE = 1000
+# Rows fetched from server-side cursor at once in streaming mode
+USERS_STREAM_CHUNK = 500
 
 
 FilterUserForm = t.Dict({
@@ -54,9 +75,35 @@ FilterUserForm = t.Dict({
         t.Key("email", default=None, optional=True): t.String | t.Null,
         t.Key("fullname", default=None, optional=True): t.String | t.Null
     }),
+    t.Key("limit", default=USERS_PAGE_SIZE): t.Int(gte=1,
+                                                   lte=USERS_MAX_PAGE_SIZE),
+    t.Key("cursor", default=None): t.String | t.Null,
+    t.Key("stream", default=False): t.Bool(),
 })
 
 
+UsersCursor = t.Tuple(t.String(allow_blank=True),
+                      t.String(allow_blank=True),
+                      t.Int[0:])
+
+
+def encode_users_cursor(user):
+    """Makes opaque cursor pointing right after user in users list."""
+    key = [user['firstname'], user['lastname'], user['id']]
+    return base64.urlsafe_b64encode(
+        json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_users_cursor(cursor):
+    """Returns (firstname, lastname, id) key encoded in cursor."""
+    try:
+        key = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return UsersCursor(key)
+    except (ValueError, t.DataError):
+        raise JsonBodyValidationError(fields={'cursor': 'Invalid cursor'})
+
+
 UpdateUserForm = t.Dict({
     t.Key('login', optional=True): t.Email,
     t.Key('newpassword', optional=True): t.String(allow_blank=True,
@@ -74,7 +121,7 @@ UserPatchParams = t.Dict({
     t.Key('lastname', optional=True): t.String(max_length=64),
     t.Key('disabled', optional=True): t.Bool(),
     t.Key('password', optional=True): t.String(max_length=256),
-    t.Key('salt', optional=True): t.String(max_length=256),
+    t.Key('salt', optional=True): t.String(max_length=256) | t.Null,
 }).ignore_extra('*')
 
 
@@ -82,13 +129,45 @@ UserPatchParams = t.Dict({
 class UsersHandler(BaseHandler):
     """Users and login handler."""
 
-    @template('index.jinja2')
+    passwords = injections.depends(PasswordsManager)
+
+    # User with all his roles, one row per role
+    _login_query = queries.register('user_login', select([
+        db.user, db.roles.c.id.label('role_id'), db.roles.c.role_name,
+    ]).select_from(
+        db.user
+        .outerjoin(db.user_roles, db.user_roles.c.user_id == db.user.c.id)
+        .outerjoin(db.roles, db.roles.c.id == db.user_roles.c.role_id)
+    ).where(db.user.c.login == sa.bindparam('login')))
+
+    _user_query = queries.register(
+        'user_by_id',
+        db.user.select().where(db.user.c.id == sa.bindparam('user_id')))
+
+    _rehash_query = queries.register(
+        'user_rehash_password',
+        db.user.update()
+        .values(password=sa.bindparam('new_password'), salt=None)
+        .where(db.user.c.id == sa.bindparam('user_id'))
+        .where(db.user.c.password == sa.bindparam('old_password')))
+
+    # (user_id, id, role_name) rows of roles of listed users
+    _roles_query = queries.register('users_roles', select([
+        db.user_roles.c.user_id, db.roles.c.id, db.roles.c.role_name,
+    ]).select_from(
+        db.roles.join(db.user_roles)
+    ).where(
+        db.user_roles.c.user_id == sa.any_(sa.bindparam(
+            'user_ids', type_=postgresql.ARRAY(sa.Integer)))
+    ).order_by(db.user_roles.c.user_id))
+
     @asyncio.coroutine
     def index(self, request):
         """Index page, needed for rendering basic html with app script.
         Request: 'GET', '/'
         """
-        return {'APP_VERSION': __version__}
+        return render_template('index.jinja2', request,
+                               {'APP_VERSION': __version__})
 
     @validate(LoginUser, as_kwargs=True)
     @asyncio.coroutine
@@ -98,21 +177,26 @@ class UsersHandler(BaseHandler):
         """
 
         with (yield from self.postgres) as pg_con:
-            row = yield from pg_con.execute(
-                db.user.select().where(db.user.c.login == username))
-            rec = yield from row.first()
-        if not rec:
+            cursor = yield from self._login_query.execute(
+                pg_con, login=username)
+            rows = yield from cursor.fetchall()
+        if not rows:
             raise InvalidLogin()
+        rec = rows[0]
         if rec.disabled:
             raise UserDisabled()
 
-        pw_hash = calculate_hash(password, rec.salt)
-        if pw_hash != rec.password:
+        valid, needs_rehash = yield from self.passwords.verify(
+            password, rec.password, rec.salt)
+        if not valid:
             raise InvalidLogin()
+        if needs_rehash:
+            yield from self._rehash_password(rec, password)
 
         token = self.tokens.make_access_token()
-        user = dict(rec)
-        yield from self._add_roles(user)
+        user = {key: rec[key] for key in db.user.c.keys()}
+        user['roles'] = [{'id': row.role_id, 'role_name': row.role_name}
+                         for row in rows if row.role_id is not None]
         user = UserView(user)
 
         session = {'uid': rec.id, 'username': rec.login}
@@ -128,15 +212,12 @@ class UsersHandler(BaseHandler):
         """
 
         user_row = {}
-        session = yield from self.auth_admin_session(request,
-                                                     Permission.users_add)
+        principal = self.auth_admin_session(
+            request, Permission.users_add)
+        form['password'] = yield from self.passwords.hash(form['password'])
+        form['salt'] = None
         with (yield from self.postgres) as pg_con:
             try:
-                salt = generate_salt()
-                password_hash = calculate_hash(form['password'], salt)
-                form['password'] = password_hash
-                form['salt'] = salt
-
                 cursor = yield from pg_con.execute(db.user.insert()
                                                    .returning(*db.user.c)
                                                    .values(form))
@@ -147,10 +228,10 @@ class UsersHandler(BaseHandler):
                         fields={'login': 'such user login already exists'})
                 raise
 
-        user = dict(user_row)
-        yield from self._add_roles(user)
+            user = dict(user_row)
+            yield from self._add_roles(pg_con, user)
 
-        yield from self.log_admin_action(request, session, form)
+        yield from self.log_admin_action(request, principal, form)
 
         return UserView(user)
 
@@ -162,18 +243,15 @@ class UsersHandler(BaseHandler):
         """
 
         user_id = self.get_user_id(request)
-        yield from self.auth_user_session(user_id, request,
-                                          Permission.users_view)
+        self.auth_user_session(user_id, request, Permission.users_view)
         with (yield from self.postgres) as pg_con:
-            cursor = yield from pg_con.execute(
-                db.user.select()
-                .where(db.user.c.id == user_id)
-            )
+            cursor = yield from self._user_query.execute(
+                pg_con, user_id=user_id)
             user = yield from cursor.first()
-        if not user:
-            raise ObjectNotFound()
-        user = dict(user)
-        yield from self._add_roles(user)
+            if not user:
+                raise ObjectNotFound()
+            user = dict(user)
+            yield from self._add_roles(pg_con, user)
 
         return UserView(user)
 
@@ -185,57 +263,58 @@ class UsersHandler(BaseHandler):
         """
 
         user_id = self.get_user_id(request)
-        session = yield from self.auth_user_session(user_id, request,
-                                                    Permission.users_edit)
+        principal = self.auth_user_session(
+            user_id, request, Permission.users_edit)
 
-        same_user = user_id == session['uid']
+        same_user = user_id == principal.uid
 
+        # Connection is not held while passwords are hashed
         with (yield from self.postgres) as pg_con:
-            cursor = yield from pg_con.execute(
-                db.user.select().where(db.user.c.id == user_id))
+            cursor = yield from self._user_query.execute(
+                pg_con, user_id=user_id)
             user = yield from cursor.first()
-            if not user:
-                raise ObjectNotFound()
-
-            if form.get('disabled'):
-                if same_user:
-                    raise JsonBodyValidationError(
-                        fields={'disabled': 'User can not disable himself'})
-                yield from self.tokens.invalidate_admin_session(user_id)
+        if not user:
+            raise ObjectNotFound()
 
-            if 'password' in form and 'newpassword' not in form:
-                raise JsonBodyValidationError(
-                    fields={'newpassword': 'Can not reset password '
-                                           'without newpassword'})
-
-            if 'newpassword' in form:
-                if same_user:
-                    if 'password' in form:
-                        password_hash = calculate_hash(form['password'],
-                                                       user.salt)
-                        if password_hash != user.password:
-                            raise JsonBodyValidationError(
-                                fields={'password': 'Invalid old password'})
-                    else:
+        if form.get('disabled') and same_user:
+            raise JsonBodyValidationError(
+                fields={'disabled': 'User can not disable himself'})
+
+        if 'password' in form and 'newpassword' not in form:
+            raise JsonBodyValidationError(
+                fields={'newpassword': 'Can not reset password '
+                                       'without newpassword'})
+
+        if 'newpassword' in form:
+            if same_user:
+                if 'password' in form:
+                    valid, _ = yield from self.passwords.verify(
+                        form['password'], user.password, user.salt)
+                    if not valid:
                         raise JsonBodyValidationError(
-                            fields={'newpassword': 'Can not change password '
-                                                   'without old one'})
+                            fields={'password': 'Invalid old password'})
                 else:
-                    if 'password' in form:
-                        raise JsonBodyValidationError(
-                            fields={'password': 'Do not pass if editing '
-                                                'other users'})
-                    yield from self._check_reset_pass(session['uid'])
+                    raise JsonBodyValidationError(
+                        fields={'newpassword': 'Can not change password '
+                                               'without old one'})
+            else:
+                if 'password' in form:
+                    raise JsonBodyValidationError(
+                        fields={'password': 'Do not pass if editing '
+                                            'other users'})
+                principal.check_permission(
+                    Permission.users_reset_password)
 
-                # Checks completed, nothing raised. Changing password.
-                salt = generate_salt()
-                form['password'] = calculate_hash(form['newpassword'], salt)
-                form['salt'] = salt
+            # Checks completed, nothing raised. Changing password.
+            form['password'] = yield from self.passwords.hash(
+                form['newpassword'])
+            form['salt'] = None
 
-            patch = UserPatchParams(form)
-            if not patch:
-                raise JsonBodyValidationError("Nothing to update")
+        patch = UserPatchParams(form)
+        if not patch:
+            raise JsonBodyValidationError("Nothing to update")
 
+        with (yield from self.postgres) as pg_con:
             try:
                 cursor = yield from pg_con.execute(
                     db.user.update()
@@ -247,12 +326,18 @@ class UsersHandler(BaseHandler):
                     fields={'login': 'User already exists'})
 
             user = yield from cursor.first()
-            assert user, "Can not patch username"
+            if not user:
+                # Deleted meanwhile
+                raise ObjectNotFound()
+
+            patched_user = dict(user)
+            yield from self._add_roles(pg_con, patched_user)
 
-        patched_user = dict(user)
-        yield from self._add_roles(patched_user)
+        if form.get('disabled'):
+            yield from self.tokens.invalidate_admin_session(user_id)
+        yield from self.permissions.invalidate(user_id)
 
-        yield from self.log_admin_action(request, session, form)
+        yield from self.log_admin_action(request, principal, form)
 
         return UserView(patched_user)
 
@@ -263,12 +348,9 @@ class UsersHandler(BaseHandler):
         Request: 'DELETE', '/admin/users/{uid}'
         """
 
-        session = yield from self.tokens.get_admin_session(request)
-        super_user_id = session['uid']
+        principal = self.auth_superadmin_session(request)
         user_id = self.get_user_id(request)
 
-        if not (yield from self.permissions.is_superuser(super_user_id)):
-            raise PermissionDenied(reason='Must be superadmin')
         if (yield from self.permissions.is_superuser(user_id)):
             raise PermissionDenied(reason='Can not delete superadmin')
 
@@ -282,47 +364,230 @@ class UsersHandler(BaseHandler):
         if not deleted_user:
             raise ObjectNotFound()
 
-        yield from self.log_admin_action(request, session)
+        yield from self.permissions.invalidate(user_id)
+
+        yield from self.log_admin_action(request, principal)
 
         return {'status': 'deleted'}
 
+    @asyncio.coroutine
+    def users_import(self, request):
+        """Create users listed in request body, one per line, in NDJSON or
+        CSV (with header) format. Users with existing logins are skipped.
+        Request: 'POST', '/admin/users/bulk'
+        Response is NDJSON report with line per user, followed by summary.
+        """
+
+        principal = self.auth_admin_session(request, Permission.users_add)
+        if request.content_type == 'text/csv':
+            header = yield from request.content.readline()
+            try:
+                parse = self._csv_user_parser(header)
+            except (ValueError, csv.Error):
+                # UnicodeDecodeError included
+                raise JsonBodyValidationError("Invalid CSV header")
+        else:
+            def parse(line):
+                return json.loads(line.decode('utf-8'))
+
+        response = yield from renderer.stream_response(
+            request, 'application/x-ndjson')
+
+        summary = {'created': 0, 'exists': 0, 'invalid': 0}
+        batch = []
+        lineno = 0
+        while True:
+            line = yield from request.content.readline()
+            if line:
+                lineno += 1
+                if not line.strip():
+                    continue
+                batch.append((lineno, line))
+            if batch and (not line or len(batch) >= USERS_IMPORT_BATCH):
+                report = yield from self._import_users_batch(batch, parse)
+                for item in report:
+                    summary[item['status']] += 1
+                    response.write(renderer.dumps(item) + b'\n')
+                yield from response.drain()
+                batch = []
+            if not line:
+                break
+
+        response.write(renderer.dumps({'summary': summary}))
+        yield from response.write_eof()
+
+        yield from self.log_admin_action(request, principal, summary)
+        return response
+
+    def _csv_user_parser(self, header):
+        fields = next(csv.reader([header.decode('utf-8')]))
+
+        def parse(line):
+            values = next(csv.reader([line.decode('utf-8')]))
+            user = dict(zip(fields, values))
+            for key in ('disabled', 'is_superuser'):
+                if key in user:
+                    user[key] = USERS_IMPORT_CSV_BOOLS.get(
+                        user[key].strip().lower(), user[key])
+            return user
+
+        return parse
+
+    @asyncio.coroutine
+    def _import_users_batch(self, batch, parse):
+        """Validates, hashes and inserts users of (lineno, line) pairs,
+        returns report item per line.
+        """
+
+        report = {}
+        users = {}
+        for lineno, line in batch:
+            try:
+                user = CreateUserForm(parse(line))
+            except (ValueError, csv.Error) as exc:
+                # Invalid UTF-8 (UnicodeDecodeError), JSON, CSV or fields
+                errors = (exc.as_dict() if isinstance(exc, t.DataError)
+                          else 'Invalid line')
+                report[lineno] = {'line': lineno, 'status': 'invalid',
+                                  'errors': errors}
+                continue
+            if user['login'] in users:
+                report[lineno] = {'line': lineno, 'status': 'invalid',
+                                  'errors': {'login': 'Duplicate login'}}
+                continue
+            users[user['login']] = (lineno, user)
+
+        if users:
+            rows = [user for _, user in users.values()]
+            hashes = yield from asyncio.gather(
+                *[self.passwords.hash(user['password']) for user in rows],
+                loop=self._loop)
+            with (yield from self.postgres) as pg_con:
+                cursor = yield from pg_con.execute(
+                    _IMPORT_USERS_QUERY,
+                    login=[user['login'] for user in rows],
+                    password=hashes,
+                    firstname=[user['firstname'] for user in rows],
+                    lastname=[user['lastname'] for user in rows],
+                    disabled=[user['disabled'] for user in rows],
+                    is_superuser=[user.get('is_superuser', False)
+                                  for user in rows])
+                created = {row.login: row.id
+                           for row in (yield from cursor.fetchall())}
+
+            for login, (lineno, _) in users.items():
+                if login in created:
+                    report[lineno] = {'line': lineno, 'status': 'created',
+                                      'uid': created[login]}
+                else:
+                    report[lineno] = {'line': lineno, 'status': 'exists'}
+
+        return [report[lineno] for lineno in sorted(report)]
+
     @validate(FilterUserForm, check_param='json_body')
     @asyncio.coroutine
     def users_list(self, request, form):
-        """List users.
+        """List users ordered by full name, page by page.
         Request: 'GET', 'admin/user/'
+        If `stream` is passed all users after cursor are streamed as JSON
+        array instead of a page.
         """
 
-        yield from self.auth_admin_session(request, Permission.user_view)
+        self.auth_admin_session(request, Permission.users_view)
+        query = self._users_list_query(form)
+        if form['stream']:
+            return (yield from self._stream_users(request, query))
+
         with (yield from self.postgres) as pg_con:
-            query = db.user.select()
-            if form['filter']['fullname']:
-                fname, *lname_tail = form['filter']['fullname'].split(' ')
-                if lname_tail:
-                    expr = or_(db.user.c.firstname.like(fname + '%'),
-                               *[db.user.c.lastname.like(word + '%')
-                                 for word in lname_tail])
-                else:
-                    expr = or_(db.user.c.firstname.like(fname + '%'),
-                               db.user.c.lastname.like(fname + '%'))
+            cursor = yield from pg_con.execute(query.limit(form['limit'] + 1))
+            users = list(map(dict, (yield from cursor.fetchall())))
+
+            next_cursor = None
+            if len(users) > form['limit']:
+                del users[form['limit']:]
+                next_cursor = encode_users_cursor(users[-1])
+            if users:
+                yield from self._add_roles(pg_con, users)
+
+        return {'users': [UserView(user) for user in users],
+                'cursor': next_cursor}
+
+    def _users_list_query(self, form):
+        """Builds users query ordered by (firstname, lastname, id) key and
+        starting right after the key in form's cursor.
+        """
+
+        query = db.user.select()
+        if form['filter']['fullname']:
+            expr = user_fullname_filter(form['filter']['fullname'])
+            if expr is not None:
                 query = query.where(expr)
 
-            if form['filter']['email']:
-                query = query.where(
-                    db.user.c.login.like(form['filter']['email'] + '%')
-                )
+        if form['filter']['email']:
+            query = query.where(user_email_filter(form['filter']['email']))
 
-            cursor = yield from pg_con.execute(
-                query.order_by('firstname', 'lastname')
-            )
-            users = yield from cursor.fetchall()
-            users = list(map(dict, users))
-            yield from self._add_roles(users)
+        key = tuple_(db.user.c.firstname, db.user.c.lastname, db.user.c.id)
+        if form['cursor']:
+            query = query.where(
+                key > tuple_(*decode_users_cursor(form['cursor'])))
 
-            return [UserView(user) for user in users]
+        return query.order_by(db.user.c.firstname,
+                              db.user.c.lastname,
+                              db.user.c.id)
 
     @asyncio.coroutine
-    def _add_roles(self, user_or_users):
+    def _stream_users(self, request, query):
+        """Writes users as JSON array, chunk by chunk, reading them from
+        server-side cursor, so no more than one chunk is held in memory.
+        """
+
+        compiled = query.compile(dialect=self.postgres.dialect)
+
+        with (yield from self.postgres) as pg_con:
+            # Named cursors are not supported by psycopg2 in async mode,
+            # so declare one by hand, it lives until transaction ends
+            transaction = yield from pg_con.begin()
+            try:
+                yield from pg_con.execute(
+                    'DECLARE users_list NO SCROLL CURSOR FOR ' + str(compiled),
+                    compiled.params)
+                response = yield from renderer.stream_response(request)
+                writer = JSONArrayWriter(response, dumps=renderer.dumps)
+                while True:
+                    cursor = yield from pg_con.execute(
+                        'FETCH {} FROM users_list'.format(USERS_STREAM_CHUNK))
+                    users = list(map(dict, (yield from cursor.fetchall())))
+                    if not users:
+                        break
+                    yield from self._add_roles(pg_con, users)
+                    for user in users:
+                        writer.write(UserView(user))
+                    yield from writer.flush()
+                yield from writer.close()
+            finally:
+                # Read-only transaction, rollback just closes the cursor
+                yield from transaction.rollback()
+
+        yield from response.write_eof()
+        return response
+
+    @asyncio.coroutine
+    def _rehash_password(self, user, password):
+        """Replaces user's hash made by outdated algorithm or cost
+        parameters. Skipped if password was changed meanwhile.
+        """
+
+        password_hash = yield from self.passwords.hash(password)
+        with (yield from self.postgres) as pg_con:
+            yield from self._rehash_query.execute(
+                pg_con, user_id=user.id, old_password=user.password,
+                new_password=password_hash)
+
+    @asyncio.coroutine
+    def _add_roles(self, conn, user_or_users):
+        """Sets roles of user or users list, querying them on connection
+        held by caller.
+        """
         if not isinstance(user_or_users, list):
             users = [user_or_users]
         else:
@@ -331,26 +596,8 @@ class UsersHandler(BaseHandler):
         user_id_map = dict(((x['id'], x) for x in users))
         user_ids = list(user_id_map)
 
-        with (yield from self.postgres) as conn:
-            cursor = yield from conn.execute(
-                select([db.user_roles.c.user_id,
-                        db.roles.c.id,
-                        db.roles.c.role_name])
-                .select_from(db.roles.join(db.user_roles))
-                .where(db.user_roles.c.user_id.in_(user_ids))
-                .order_by(db.user_roles.c.user_id)
-            )
-            roles = yield from cursor.fetchall()
-            for user_id, roles in itertools.groupby(
-                    roles, key=lambda x: x.user_id):
-                user_id_map[user_id]['roles'] = list(map(dict, roles))
-
-    @asyncio.coroutine
-    def _check_reset_pass(self, user_id):
-        try:
-            yield from self.permissions.check(
-                user_id, Permission.user_reset_password)
-        except PermissionDenied:
-            raise
-        else:
-            return True
+        cursor = yield from self._roles_query.execute(conn, user_ids=user_ids)
+        roles = yield from cursor.fetchall()
+        for user_id, roles in itertools.groupby(
+                roles, key=lambda x: x.user_id):
+            user_id_map[user_id]['roles'] = list(map(dict, roles))
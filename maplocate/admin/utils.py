@@ -1,6 +1,7 @@
+import base64
 import logging
-import random
-import string
+import os
+import pathlib
 import hashlib
 import asyncio
 import json
@@ -11,13 +12,15 @@ from datetime import datetime, timezone
 from trafaret import DataError
 
 from .exceptions import JsonBodyValidationError
+from .serializers import renderer
 
 
 log = logging.getLogger(__name__)
 
 
-POPULATION = (string.ascii_letters + string.digits) * 10
-RANDOM = random.SystemRandom()
+SALT_SIZE = 16
+
+TEMPLATES_ROOT = pathlib.Path(__file__).parent.parent / 'templates'
 
 
 def utc_now():
@@ -25,8 +28,9 @@ def utc_now():
 
 
 def generate_salt():
-    salt = ''.join(RANDOM.sample(POPULATION, 256))
-    return salt
+    """Returns random salt as URL-safe base64 string without padding."""
+    salt = base64.urlsafe_b64encode(os.urandom(SALT_SIZE))
+    return salt.rstrip(b'=').decode('ascii')
 
 
 def calculate_hash(password, salt):
@@ -38,11 +42,6 @@ def calculate_hash(password, salt):
     return password_hash
 
 
-def validate_password(password, password_hash, salt):
-    """Returns True if password equals hashed one."""
-    return calculate_hash(password, salt) == password_hash
-
-
 @asyncio.coroutine
 def check_trafaret(traf, data, *, raise_error=True):
     """Applies trafaret to data and raises RESTError instead of DataError."""
@@ -75,6 +74,41 @@ def get_json_param(request, check_param, traf=None):
     return json_data
 
 
+def render_template(template_name, request, context):
+    """Renders jinja2 template into web.Response.
+    jinja2 is imported and set up on first render, as only index page
+    needs it and it is slow to import.
+    """
+    import aiohttp_jinja2
+
+    if aiohttp_jinja2.APP_KEY not in request.app:
+        import jinja2
+
+        aiohttp_jinja2.setup(
+            request.app, loader=jinja2.FileSystemLoader(str(TEMPLATES_ROOT)))
+    return aiohttp_jinja2.render_template(template_name, request, context)
+
+
+def _opaque_tag(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def check_etag(request, etag):
+    """Raises HTTPNotModified if request's If-None-Match matches etag."""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is None:
+        return
+    opaque_tag = _opaque_tag(etag)
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        # Weak comparison, as required for If-None-Match
+        if tag == '*' or _opaque_tag(tag) == opaque_tag:
+            not_modified = web.HTTPNotModified(headers={'ETag': etag})
+            # Has no body, so no default application/octet-stream type
+            del not_modified.headers['Content-Type']
+            raise not_modified
+
+
 def render_json(func):
     assert asyncio.iscoroutinefunction(func), func
 
@@ -82,12 +116,14 @@ def render_json(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         ret = yield from func(*args, **kwargs)
+        if isinstance(ret, web.StreamResponse):
+            # Handler has already written response itself
+            return ret
         try:
-            text = json.dumps(ret)
+            return renderer.response(ret)
         except TypeError:
             raise RuntimeError("{!r} result {!r} is not serializable".format(
                 func, ret))
-        return web.Response(text=text, content_type='application/json')
 
     return wrapper
 
@@ -0,0 +1,52 @@
+"""Output views of database rows.
+
+Rows come from our own schema, so they are not validated on the way out
+like request data. View is a generated function projecting row (any
+mapping, RowProxy included) into dict of public fields. Fields are
+listed explicitly, so new columns are not published unless added here.
+"""
+__all__ = ['make_view', 'UserView', 'RoleView', 'UserRoleView']
+
+
+def make_view(name, columns, *, rename=None, computed=None):
+    """Returns function `name(row)` making dict of `columns` of row.
+
+    `rename` maps column names to output keys, `computed` maps extra output
+    keys to functions of row.
+
+    >>> view = make_view('View', ['id', 'name'], rename={'id': 'uid'})
+    >>> view({'id': 1, 'name': 'Bob', 'password': 'secret'})
+    {'uid': 1, 'name': 'Bob'}
+    """
+    rename = rename or {}
+    namespace = {}
+    items = ['{!r}: row[{!r}]'.format(rename.get(column, column), column)
+             for column in columns]
+    for index, (key, func) in enumerate((computed or {}).items()):
+        namespace['_computed{}'.format(index)] = func
+        items.append('{!r}: _computed{}(row)'.format(key, index))
+    source = 'def {}(row):\n    return {{{}}}\n'.format(name, ', '.join(items))
+    exec(source, namespace)
+    view = namespace[name]
+    view.__doc__ = 'Projects row into {} dict.'.format(name)
+    return view
+
+
+# Role as listed in user's profile
+UserRoleView = make_view('UserRoleView', ['id', 'role_name'])
+
+RoleView = make_view(
+    'RoleView',
+    ['id', 'role_name', 'description'],
+    computed={
+        'permissions': lambda row: row['permissions'] or [],
+    })
+
+UserView = make_view(
+    'UserView',
+    ['id', 'login', 'firstname', 'lastname', 'disabled', 'is_superuser'],
+    rename={'id': 'uid'},
+    computed={
+        'roles': lambda row: [UserRoleView(role)
+                              for role in row.get('roles', ())],
+    })
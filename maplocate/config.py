@@ -2,11 +2,14 @@ import logging
 import logging.config
 import yaml
 import asyncio
+import operator
 import aiopg.sa
 import aioredis
 
 import trafaret as t
 
+from maplocate.pools import MonitoredPool
+
 
 def init_logging(options):
     conf = options.log_config
@@ -31,37 +34,122 @@ def load_config(config_file, config_trafaret):
 
 PostgresConf = t.Forward()
 RedisConf = t.Forward()
+PermissionsCacheConf = t.Forward()
+PasswordsConf = t.Forward()
+SessionsCacheConf = t.Forward()
+JSONConf = t.Forward()
+ServerConf = t.Forward()
+TracingConf = t.Forward()
 
 maplocate_trafaret = t.Dict({
     t.Key('postgres'): PostgresConf,
     t.Key('redis'): RedisConf,
+    t.Key('permissions_cache', default={}): PermissionsCacheConf,
+    t.Key('passwords', default={}): PasswordsConf,
+    t.Key('sessions_cache', default={}): SessionsCacheConf,
+    t.Key('json', default={}): JSONConf,
+    t.Key('server', default={}): ServerConf,
+    t.Key('tracing', default={}): TracingConf,
 })
 
 
 # trafaret shortcuts definition
 
+def _check_pool_sizes(conf):
+    if conf['minsize'] > conf['maxsize']:
+        raise t.DataError('minsize is greater than maxsize')
+    return conf
+
+
+# Pools of Postgres and Redis: checkouts fail after acquire_timeout
+# seconds of waiting for free connection, connections are closed after
+# recycle seconds since first checkout, both are unlimited if not set.
+# Postgres timeout is aiopg timeout of connecting and of each query.
 PostgresConf << t.Dict({
     t.Key('database'): t.String,
     t.Key('user'): t.String,
     t.Key('password'): t.String,
     t.Key('host', default='127.0.0.1'): t.String,
     t.Key('port', default=5432): t.Int,
-    t.Key('minsize', default=10): t.Int,
-    t.Key('maxsize', default=10): t.Int,
+    t.Key('minsize', default=10): t.Int[0:],
+    t.Key('maxsize', default=10): t.Int[1:],
+    t.Key('timeout', default=aiopg.DEFAULT_TIMEOUT): t.Float[0:],
+    t.Key('acquire_timeout', default=None): t.Float[0:] | t.Null,
+    t.Key('recycle', default=None): t.Float[0:] | t.Null,
     t.Key('connection_timeout', default=None): t.Int | t.Null,
-})
+}).append(_check_pool_sizes)
 
 RedisConf << t.Dict({
     t.Key('address'): t.Tuple(t.String, t.Int) | t.String,
     t.Key('db', default=1): t.Int[0:],
+    t.Key('minsize', default=1): t.Int[0:],
+    t.Key('maxsize', default=10): t.Int[1:],
+    t.Key('acquire_timeout', default=None): t.Float[0:] | t.Null,
+    t.Key('recycle', default=None): t.Float[0:] | t.Null,
     t.Key('connection_timeout', default=None): t.Int | t.Null,
+}).append(_check_pool_sizes)
+
+PermissionsCacheConf << t.Dict({
+    t.Key('maxsize', default=1024): t.Int[1:],
+    t.Key('ttl', default=60): t.Int[1:],
+})
+
+# Sessions are cached only if maxsize is set, ttl is max staleness
+# of cached session in seconds.
+SessionsCacheConf << t.Dict({
+    t.Key('maxsize', default=None): t.Int[1:] | t.Null,
+    t.Key('ttl', default=5): t.Int[1:],
+})
+
+PasswordsConf << t.Dict({
+    t.Key('algorithm', default='pbkdf2_sha256'): t.Enum('pbkdf2_sha256',
+                                                        'scrypt'),
+    t.Key('pbkdf2_iterations', default=100000): t.Int[1:],
+    t.Key('scrypt', default={}): t.Dict({
+        t.Key('n', default=16384): t.Int[2:],
+        t.Key('r', default=8): t.Int[1:],
+        t.Key('p', default=1): t.Int[1:],
+    }),
+    # Executor hashing passwords off the event loop
+    t.Key('executor', default='thread'): t.Enum('thread', 'process'),
+    t.Key('workers', default=4): t.Int[1:],
+    # Max hashes being calculated or queued in executor at once
+    t.Key('max_concurrency', default=8): t.Int[1:],
+})
+
+# On SIGTERM readiness check fails at once, connections are still accepted
+# for drain_delay seconds, then in-flight requests are given
+# shutdown_timeout seconds to complete.
+ServerConf << t.Dict({
+    t.Key('drain_delay', default=0): t.Float[0:],
+    t.Key('shutdown_timeout', default=20): t.Float[0:],
+})
+
+# Postgres statements and Redis commands slower than slow_threshold
+# seconds are logged. Server-Timing header with timings of statements is
+# added to responses if server_timing is set (debug only, it discloses
+# statement names). Statements are not traced if neither is set.
+TracingConf << t.Dict({
+    t.Key('slow_threshold', default=None): t.Float[0:] | t.Null,
+    t.Key('server_timing', default=False): t.Bool(),
+})
+
+# Responses are compressed only if compress_min_size (in bytes) is set,
+# 'auto' encoder is the fastest installed one.
+JSONConf << t.Dict({
+    t.Key('encoder', default='auto'): t.Enum(
+        'auto', 'orjson', 'ujson', 'rapidjson', 'json'),
+    t.Key('compress_min_size', default=None): t.Int[0:] | t.Null,
 })
 
 log = logging.getLogger(__name__)
 
 
 @asyncio.coroutine
-def init_postgres(inj, config, loop):
+def init_postgres(inj, config, loop, *, lazy=False):
+    """Creates Postgres pool wrapped into MonitoredPool. If `lazy` is set
+    only one connection is opened, see warm_up_postgres().
+    """
     log.info('Connecting to Postgres => %s:%s', config['host'], config['port'])
     try:
         fut = aiopg.sa.create_engine(
@@ -70,26 +158,51 @@ def init_postgres(inj, config, loop):
             password=config['password'],
             host=config['host'],
             port=config['port'],
-            minsize=config['minsize'],
+            minsize=min(config['minsize'], 1) if lazy else config['minsize'],
             maxsize=config['maxsize'],
+            timeout=config['timeout'],
             loop=loop)
         engine = yield from asyncio.wait_for(
             fut, timeout=config['connection_timeout'])
-        inj['postgres'] = engine
+        inj['postgres'] = MonitoredPool(
+            engine, 'postgres', loop=loop,
+            acquire_timeout=config['acquire_timeout'],
+            recycle=config['recycle'],
+            raw=operator.attrgetter('connection'))
     except asyncio.TimeoutError:
         log.error('Timeout connection to PostgreSQL')
         raise
 
 
+@asyncio.coroutine
+def warm_up_postgres(engine, size):
+    """Opens pool connections up to `size` (but not above maxsize), so
+    they are not opened by first requests.
+    """
+    size = min(size, engine.maxsize)
+    conns = []
+    try:
+        while engine.size < size:
+            conns.append((yield from engine.acquire()))
+    finally:
+        for conn in conns:
+            engine.release(conn)
+    log.info('Postgres pool is warmed up to %d connections', engine.size)
+
+
 @asyncio.coroutine
 def init_redis(inj, config, loop):
     log.info('Connecting to Redis => %s', config['address'])
     try:
         fut = aioredis.create_pool(
-            config['address'], db=config['db'], loop=loop)
+            config['address'], db=config['db'],
+            minsize=config['minsize'], maxsize=config['maxsize'], loop=loop)
         redis_pool = yield from asyncio.wait_for(
             fut, timeout=config['connection_timeout'])
-        inj['redis'] = redis_pool
+        inj['redis'] = MonitoredPool(
+            redis_pool, 'redis', loop=loop,
+            acquire_timeout=config['acquire_timeout'],
+            recycle=config['recycle'])
     except asyncio.TimeoutError:
         log.error('Timeout connection to Redis')
         raise
@@ -0,0 +1,115 @@
+"""Registry of hot statements compiled to SQL once.
+
+aiopg compiles SQLAlchemy expression into SQL text on every execute().
+Statements registered here use ``sa.bindparam()`` for all variable parts,
+are compiled once at startup (see `QueryRegistry.compile_all()`) and then
+executed as plain SQL with bound parameters.
+
+psycopg2 in asynchronous mode has no server-side prepared statements, so
+only client-side compilation is cached; Postgres still plans every query.
+
+Usage::
+
+    user_by_id = queries.register(
+        'user_by_id',
+        db.user.select().where(db.user.c.id == sa.bindparam('user_id')))
+    ...
+    cursor = yield from user_by_id.execute(conn, user_id=1)
+"""
+import asyncio
+import collections
+
+from sqlalchemy.dialects.postgresql import psycopg2 as pg_psycopg2
+
+__all__ = ['CompiledQuery', 'QueryRegistry', 'queries']
+
+
+class CompiledQuery:
+    """Statement compiled on first use (or by registry) and then reused.
+
+    `hits` counts executions which did not compile statement,
+    `compiles` counts compilations.
+    """
+
+    def __init__(self, name, statement, *, dialect):
+        self.name = name
+        self.statement = statement
+        self.dialect = dialect
+        self.sql = None
+        self.hits = 0
+        self.compiles = 0
+        self._compiled = None
+        self._processors = None
+
+    def compile(self, dialect=None):
+        if dialect is not None:
+            self.dialect = dialect
+        self._compiled = self.statement.compile(dialect=self.dialect)
+        self._processors = self._compiled._bind_processors
+        self.sql = self._compiled.string
+        self.compiles += 1
+
+    def params(self, **params):
+        """Returns DBAPI parameters, bound values processed the same way
+        aiopg does for expressions.
+        Raises sqlalchemy.exc.InvalidRequestError if parameter is missing.
+        """
+        processors = self._processors
+        return {key: processors[key](value) if key in processors else value
+                for key, value in
+                self._compiled.construct_params(params).items()}
+
+    @asyncio.coroutine
+    def execute(self, conn, **params):
+        """Executes statement on aiopg.sa connection, returns ResultProxy."""
+        if self._compiled is None:
+            self.compile()
+        else:
+            self.hits += 1
+        return (yield from conn.execute(self.sql, self.params(**params)))
+
+    def __repr__(self):
+        return '<CompiledQuery {} hits={} compiles={}>'.format(
+            self.name, self.hits, self.compiles)
+
+
+class QueryRegistry:
+    """Named hot statements of the application."""
+
+    def __init__(self, dialect=None):
+        if dialect is None:
+            dialect = pg_psycopg2.dialect()
+        self.dialect = dialect
+        self._queries = collections.OrderedDict()
+
+    def register(self, name, statement):
+        """Registers statement under unique name, returns CompiledQuery."""
+        if name in self._queries:
+            raise ValueError("Query {!r} is already registered".format(name))
+        query = self._queries[name] = CompiledQuery(
+            name, statement, dialect=self.dialect)
+        return query
+
+    def compile_all(self, dialect=None):
+        """Compiles all registered statements, pass engine's dialect to get
+        the same SQL aiopg would produce.
+        """
+        if dialect is not None:
+            self.dialect = dialect
+        for query in self._queries.values():
+            query.compile(self.dialect)
+
+    def __getitem__(self, name):
+        return self._queries[name]
+
+    def __iter__(self):
+        return iter(self._queries.values())
+
+    def stats(self):
+        """Returns {name: (hits, compiles)} of all registered statements."""
+        return {query.name: (query.hits, query.compiles)
+                for query in self._queries.values()}
+
+
+# Statements are registered by modules using them at import time.
+queries = QueryRegistry()
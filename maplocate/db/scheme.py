@@ -1,7 +1,7 @@
 import sqlalchemy as sa
 from sqlalchemy.dialects import postgresql
 
-__all__ = ['user', 'roles']
+__all__ = ['user', 'roles', 'user_roles', 'table_versions']
 
 meta = sa.MetaData()
 
@@ -12,18 +12,27 @@ user = sa.Table(
     "user", meta,
     sa.Column('id', sa.Integer, nullable=False),
     sa.Column('login', sa.String(64), nullable=False),
-    sa.Column('password', sa.String(256), nullable=False),
-    sa.Column('salt', sa.String(256), nullable=False),
+    # self-describing `algorithm$params$salt$hexdigest` hash
+    sa.Column('password', sa.Text, nullable=False),
+    # deprecated, NULL unless row is not backfilled yet
+    sa.Column('salt', sa.String(256)),
     sa.Column('is_superuser', sa.Boolean, nullable=False,
               server_default='False'),
     sa.Column('firstname', sa.String(64), nullable=False),
     sa.Column('lastname', sa.String(64), nullable=False),
     sa.Column('disabled', sa.Boolean, nullable=False,
               server_default='False'),
+    # generated by Postgres as lower(firstname || ' ' || lastname),
+    # never pass it to insert or update
+    sa.Column('fullname_search', sa.Text),
 
     # indexes #
     sa.PrimaryKeyConstraint('id', name='user_pkey'),
     sa.UniqueConstraint('login', name='user_login_key'),
+    sa.Index('user_fullname_key_idx', 'firstname', 'lastname', 'id'),
+    # also created by migrations:
+    #   user_fullname_search_trgm_idx: gin (fullname_search gin_trgm_ops)
+    #   user_login_lower_pattern_idx: btree (lower(login) text_pattern_ops)
 )
 
 roles = sa.Table(
@@ -51,3 +60,13 @@ user_roles = sa.Table(
                             name='user_roles_role_fkey',
                             ondelete='RESTRICT'),
 )
+
+# Version of each listed table, bumped by trigger on every modifying
+# statement. Used for ETags of rarely changed collections.
+table_versions = sa.Table(
+    'table_versions', meta,
+    sa.Column('table_name', sa.String(64), nullable=False),
+    sa.Column('version', sa.BigInteger, nullable=False, server_default='1'),
+
+    sa.PrimaryKeyConstraint('table_name', name='table_versions_pkey'),
+)
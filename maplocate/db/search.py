@@ -0,0 +1,34 @@
+"""Search conditions backed by indexes of user table."""
+import sqlalchemy as sa
+
+from . import scheme as db
+
+__all__ = ['like_escape', 'user_fullname_filter', 'user_email_filter']
+
+
+def like_escape(value):
+    """Escapes LIKE wildcards, so value is matched literally."""
+    return (value.replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def user_fullname_filter(fullname):
+    """Case-insensitive match of users having every word of fullname
+    anywhere in their full name, uses trigram index on fullname_search.
+    Returns None if there are no words to search.
+    """
+    words = fullname.lower().split()
+    if not words:
+        return None
+    return sa.and_(*[
+        db.user.c.fullname_search.like('%' + like_escape(word) + '%')
+        for word in words])
+
+
+def user_email_filter(email):
+    """Case-insensitive prefix match of login, uses
+    lower(login) text_pattern_ops index.
+    """
+    return sa.func.lower(db.user.c.login).like(
+        like_escape(email.lower()) + '%')
@@ -0,0 +1,60 @@
+"""Liveness and readiness endpoints for load balancers and orchestrators.
+
+Port is bound before dependencies are set up. Until then all requests but
+health checks are answered with 503 by `middleware`. Liveness answers 200
+while event loop serves requests at all. Readiness answers 200 only after
+startup (pools warm-up included) is completed and until shutdown starts,
+so traffic is moved to other instances before this one stops accepting
+connections.
+"""
+import asyncio
+
+from aiohttp import web
+
+__all__ = ['HealthHandler']
+
+
+class HealthHandler:
+
+    prefix = '/health/'
+
+    def __init__(self):
+        # Dependencies are set up, requests may be handled
+        self.serving = False
+        # Instance should receive traffic
+        self.ready = False
+
+    def set_serving(self):
+        self.serving = True
+
+    def set_ready(self):
+        self.serving = self.ready = True
+
+    def set_draining(self):
+        self.ready = False
+
+    @asyncio.coroutine
+    def live(self, request):
+        """Request: 'GET', '/health/live'"""
+        return web.Response(text='ok')
+
+    @asyncio.coroutine
+    def readiness(self, request):
+        """Request: 'GET', '/health/ready'"""
+        if not self.ready:
+            return web.Response(status=503, text='not ready')
+        return web.Response(text='ok')
+
+    @asyncio.coroutine
+    def middleware(self, app, handler):
+        @asyncio.coroutine
+        def middleware(request):
+            if not self.serving and not request.path.startswith(self.prefix):
+                return web.Response(status=503, text='starting',
+                                    headers={'Retry-After': '1'})
+            return (yield from handler(request))
+        return middleware
+
+    def setup_routes(self, app):
+        app.router.add_route('GET', self.prefix + 'live', self.live)
+        app.router.add_route('GET', self.prefix + 'ready', self.readiness)
@@ -1,3 +1,4 @@
+import collections
 import logging
 import aiohttp
 import asyncio
@@ -6,6 +7,10 @@ import json
 log = logging.getLogger(__name__)
 
 
+# Outcome of one item of batch operation, either result or error is set
+BatchResult = collections.namedtuple('BatchResult', 'item result error')
+
+
 class HttpClientError(Exception):
 
     @property
@@ -14,16 +19,54 @@ class HttpClientError(Exception):
 
 
 class RestClient:
+    """Client of maplocate REST API.
+
+    By default every request opens new connection. Pass `keepalive=True`
+    to reuse connections, at most `limit_per_host` of them are opened to
+    API host. `max_concurrency` limits number of requests in flight, others
+    wait for their turn. `conn_timeout` limits connection establishing and
+    `timeout` limits whole request including reading response body.
 
-    def __init__(self, api_url, token=None, *, loop):
+    Client may be used as async context manager, it is closed on exit.
+    """
+
+    def __init__(self, api_url, token=None, *, loop, keepalive=False,
+                 limit_per_host=None, conn_timeout=None, timeout=None,
+                 max_concurrency=None):
         self._api_url = api_url.rstrip('/')
         self.token = token
         self._loop = loop
-        self.connector = aiohttp.TCPConnector(force_close=True, loop=loop)
+        self._timeout = timeout
+        # Connector's limit is per endpoint (host, port, ssl)
+        self.connector = aiohttp.TCPConnector(force_close=not keepalive,
+                                              limit=limit_per_host,
+                                              conn_timeout=conn_timeout,
+                                              loop=loop)
         self.session = None
+        self._semaphore = None
+        if max_concurrency is not None:
+            self._semaphore = asyncio.Semaphore(max_concurrency, loop=loop)
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    @asyncio.coroutine
+    def request(self, method, path, data=None, params=None, json_dumps=True,
+                content_type=None):
+        if self._semaphore is None:
+            return (yield from self._request(method, path, data, params,
+                                             json_dumps, content_type))
+        with (yield from self._semaphore):
+            return (yield from self._request(method, path, data, params,
+                                             json_dumps, content_type))
 
     @asyncio.coroutine
-    def request(self, method, path, data=None, params=None, json_dumps=True):
+    def _request(self, method, path, data, params, json_dumps, content_type):
         log.debug('API Request: %s %s;\nBODY: %r', method,
                   self._api_url + path, data)
         if json_dumps and (data is not None):
@@ -32,36 +75,104 @@ class RestClient:
             headers = {'Authorization': self.token}
         else:
             headers = {}
+        if content_type is not None:
+            headers['Content-Type'] = content_type
 
         if self.session is None:
             self.session = aiohttp.ClientSession(connector=self.connector,
                                                  loop=self._loop)
 
-        resp = yield from self.session.request(method,
-                                               self._api_url + path,
-                                               params=params,
-                                               data=data,
-                                               headers=headers)
-        banswer = yield from resp.read()
+        with aiohttp.Timeout(self._timeout, loop=self._loop):
+            resp = yield from self.session.request(method,
+                                                   self._api_url + path,
+                                                   params=params,
+                                                   data=data,
+                                                   headers=headers)
+            # Reading whole body releases connection back to the pool
+            banswer = yield from resp.read()
 
         if 'text/plain' in resp.headers.get('content-type'):
             return banswer
+        if 'application/x-ndjson' in resp.headers.get('content-type'):
+            return [json.loads(line) for line in
+                    banswer.decode('utf-8').splitlines() if line]
         if resp.status in (200, 201):
             jsoned = yield from resp.json()
             return jsoned
         elif resp.status == 500:
-            raise PlainRestError(banswer.decode('utf-8'))
+            raise PlainRestError(resp.status, banswer.decode('utf-8'))
         else:
             try:
                 jsoned = yield from resp.json(encoding='utf-8')
             except ValueError:
-                raise PlainRestError(banswer.decode('utf-8'))
+                raise PlainRestError(resp.status, banswer.decode('utf-8'))
             else:
                 raise JsonRestError(resp.status, jsoned)
 
     def close(self):
         if self.session is not None:
+            # Session closes its connector too
             self.session.close()
+        else:
+            self.connector.close()
+
+    @asyncio.coroutine
+    def map_batch(self, func, items, *, workers=10, retries=3, backoff=0.5,
+                  progress=None):
+        """Calls coroutine function `func` for every item using at most
+        `workers` concurrent calls and returns list of BatchResult in order
+        of items.
+
+        Errors do not abort batch, RestClientError is stored in result.
+        Server errors (5XX), connection errors and timeouts are retried up
+        to `retries` times with exponential backoff starting from `backoff`
+        seconds. Note that retried create requests may fail with "already
+        exists" error if the first attempt reached the server.
+        `progress(done, total)` is called after every finished item.
+        """
+
+        items = list(items)
+        results = [None] * len(items)
+        pending = iter(enumerate(items))
+        done = 0
+
+        @asyncio.coroutine
+        def worker():
+            nonlocal done
+            for index, item in pending:
+                try:
+                    result = yield from self._retry(func, item, retries,
+                                                    backoff)
+                except RestClientError as exc:
+                    results[index] = BatchResult(item, None, exc)
+                else:
+                    results[index] = BatchResult(item, result, None)
+                done += 1
+                if progress is not None:
+                    progress(done, len(items))
+
+        yield from asyncio.gather(
+            *[worker() for _ in range(min(workers, len(items)))],
+            loop=self._loop)
+        return results
+
+    @asyncio.coroutine
+    def _retry(self, func, item, retries, backoff):
+        for attempt in range(retries + 1):
+            try:
+                return (yield from func(item))
+            except RestClientError as exc:
+                if attempt == retries or not is_retriable(exc):
+                    raise
+                error = exc
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    OSError) as exc:
+                if attempt == retries:
+                    raise ConnectionRestError(None, str(exc)) from exc
+                error = exc
+            delay = backoff * 2 ** attempt
+            log.warning("Retrying %r in %.1fs after %r", item, delay, error)
+            yield from asyncio.sleep(delay, loop=self._loop)
 
     # Login API
     @asyncio.coroutine
@@ -102,6 +213,29 @@ class RestClient:
         answer = yield from self.request("DELETE", path)
         return answer
 
+    @asyncio.coroutine
+    def users_import(self, users):
+        """Creates users from iterable of dicts with user_create() fields
+        in one request. Returns list of report items, one per user,
+        and summary as the last one.
+        """
+        path = '/admin/users/bulk'
+        body = b''.join(json.dumps(user).encode('utf-8') + b'\n'
+                        for user in users)
+        answer = yield from self.request(
+            "POST", path, body, json_dumps=False,
+            content_type='application/x-ndjson')
+        return answer
+
+    @asyncio.coroutine
+    def users_import_file(self, fileobj, content_type='text/csv'):
+        """Streams CSV (with header) or NDJSON file to bulk import."""
+        path = '/admin/users/bulk'
+        answer = yield from self.request(
+            "POST", path, fileobj, json_dumps=False,
+            content_type=content_type)
+        return answer
+
     @asyncio.coroutine
     def users_list(self, query=None):
         path = '/admin/users/'
@@ -157,6 +291,36 @@ class RestClient:
         answer = yield from self.request("PUT", path, body)
         return answer
 
+    @asyncio.coroutine
+    def update_users_roles(self, users_roles):
+        """Replaces roles of many users in one request,
+        `users_roles` maps user id to list of role ids.
+        """
+        path = '/admin/users/roles'
+        body = {str(user): roles for user, roles in users_roles.items()}
+        answer = yield from self.request("PUT", path, body)
+        return answer
+
+    # Batch API, see map_batch() for options and result
+    @asyncio.coroutine
+    def users_create_many(self, users, **options):
+        """Creates users described by dicts of user_create() arguments."""
+        return (yield from self.map_batch(
+            lambda user: self.user_create(**user), users, **options))
+
+    @asyncio.coroutine
+    def users_update_many(self, updates, **options):
+        """Applies (uid, body) pairs of user_update() arguments."""
+        return (yield from self.map_batch(
+            lambda update: self.user_update(*update), updates, **options))
+
+    @asyncio.coroutine
+    def update_user_roles_many(self, users_roles, **options):
+        """Applies (user, roles) pairs of update_user_roles() arguments."""
+        return (yield from self.map_batch(
+            lambda user_roles: self.update_user_roles(*user_roles),
+            users_roles, **options))
+
 
 class RestClientError(Exception):
     """Base exception class for RESTClient"""
@@ -180,3 +344,13 @@ class JsonRestError(RestClientError):
     @property
     def error_json(self):
         return self.args[1]
+
+
+class ConnectionRestError(PlainRestError):
+    """Request failed because of connection error or timeout"""
+
+
+def is_retriable(exc):
+    """Whether request failed with error which may disappear on retry."""
+    return (isinstance(exc, ConnectionRestError) or
+            isinstance(exc.status_code, int) and exc.status_code >= 500)
@@ -1,34 +1,49 @@
 import logging
+import os
 import pathlib
 import asyncio
+import signal
+import socket
 import injections
-import aiohttp_jinja2
-import jinja2
 import argsrun
 
 from aiohttp import web
 
 from maplocate.config import (init_logging, load_config, maplocate_trafaret,
-                              init_postgres, init_redis)
+                              init_postgres, warm_up_postgres, init_redis)
 from maplocate.admin.utils import log_errors_middleware
 from maplocate.admin.users import UsersHandler
 from maplocate.admin.roles import RolesHandler
 from maplocate.admin.tokens import TokensManager
-from maplocate.admin.permissions import AuthenticationPolicy
+from maplocate.admin.permissions import AuthenticationPolicy, AuthMiddleware
+from maplocate.admin.passwords import PasswordsManager, embed_salts
+from maplocate.admin.serializers import renderer
 from maplocate.admin.routes import setup_routes as setup_maplocate_routes
+from maplocate.db.queries import queries
+from maplocate.workers import Supervisor, bind_socket, bind_unix_socket
+from maplocate.health import HealthHandler
+from maplocate.metrics import metrics
+from maplocate.tracing import tracer
+from maplocate.startup import StartupTimer, import_timer
 
 log = logging.getLogger(__name__)
 
 PROJECT_ROOT = pathlib.Path(__file__).parent.parent
 
-TEMPLATES_ROOT = pathlib.Path(__file__).parent / 'templates'
 
-
-def setup_maplocate_parser(ap):
+def setup_config_parser(ap):
     ap.add_argument('--config',
                     default=PROJECT_ROOT / 'config/maplocate.yaml',
                     type=pathlib.Path,
                     help='Configuration file, default `%(default)`')
+    ap.add_argument('--log-config',
+                    default=PROJECT_ROOT / 'config/logging.yaml',
+                    type=pathlib.Path,
+                    help='Logging config file path, default `%(default)`')
+
+
+def setup_maplocate_parser(ap):
+    setup_config_parser(ap)
     ap.add_argument('--host',
                     default='localhost',
                     help='Hostname or IP-address to bind to'
@@ -39,10 +54,32 @@ def setup_maplocate_parser(ap):
     ap.add_argument('--unix-socket',
                     help='Path to unix socket to be used as transport. '
                          '`--host` and `--port` are ignored if passed')
-    ap.add_argument('--log-config',
-                    default=PROJECT_ROOT / 'config/logging.yaml',
-                    type=pathlib.Path,
-                    help='Logging config file path, default `%(default)`')
+    ap.add_argument('--workers',
+                    type=int,
+                    help='Number of worker processes to pre-fork. Each one '
+                         'has its own Postgres and Redis pools of configured '
+                         'size. Runs in single process if not passed')
+    ap.add_argument('--reuse-port',
+                    action='store_true',
+                    help='Workers bind their own sockets with SO_REUSEPORT '
+                         'instead of sharing one bound by supervisor')
+    ap.add_argument('--loop',
+                    choices=['asyncio', 'uvloop'],
+                    default='asyncio',
+                    help='Event loop implementation, falls back to asyncio '
+                         'if uvloop is not installed (default `%(default)s`)')
+
+
+def new_event_loop(name):
+    """Returns new event loop of `name` implementation."""
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            log.warning('uvloop is not installed, using asyncio event loop')
+        else:
+            return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
 
 
 def maplocate_handler(options):
@@ -51,46 +88,139 @@ def maplocate_handler(options):
     init_logging(options)
     config = load_config(options.config, maplocate_trafaret)
 
-    loop = asyncio.get_event_loop()
+    if not options.workers:
+        return serve_maplocate(options, config)
+
+    sock = None
+    if options.unix_socket:
+        sock = bind_unix_socket(options.unix_socket)
+    elif not options.reuse_port:
+        sock = bind_socket(options.host, options.port)
+
+    def worker():
+        serve_maplocate(options, config, sock=sock)
+
+    def reload():
+        nonlocal config
+        config = load_config(options.config, maplocate_trafaret)
+        log.info("Config is reloaded")
+
+    # Workers are killed if they fail to stop in time themselves
+    stop_timeout = (config['server']['drain_delay'] +
+                    config['server']['shutdown_timeout'] + 10)
+    supervisor = Supervisor(worker, options.workers, on_reload=reload,
+                            stop_timeout=stop_timeout)
+    try:
+        supervisor.run()
+    finally:
+        if sock is not None:
+            sock.close()
+        if options.unix_socket and os.path.exists(options.unix_socket):
+            os.unlink(options.unix_socket)
+
+
+def serve_maplocate(options, config, *, sock=None):
+    """Runs maplocate site in current process until SIGINT or SIGTERM,
+    accepting connections on `sock` if passed.
+    """
 
-    app = web.Application(middlewares=[log_errors_middleware], loop=loop)
+    startup = StartupTimer()
+    loop = new_event_loop(options.loop)
+    asyncio.set_event_loop(loop)
+    log.info('Using %s event loop', type(loop).__module__)
+
+    renderer.configure(
+        config['json']['encoder'],
+        compress_min_size=config['json']['compress_min_size'])
+    log.info('Rendering JSON with %s', renderer.encoder)
+    tracer.configure(
+        slow_threshold=config['tracing']['slow_threshold'],
+        server_timing=config['tracing']['server_timing'])
+
+    # Port is bound before dependencies are set up, requests are
+    # rejected by health middleware until then
+    health = HealthHandler()
+    auth_middleware = AuthMiddleware()
+    app = web.Application(
+        middlewares=[health.middleware, metrics.middleware,
+                     tracer.middleware, log_errors_middleware,
+                     auth_middleware],
+        loop=loop)
     inj = injections.Container()
 
     users_handler = UsersHandler(loop=loop)
     roles_handler = RolesHandler(loop=loop)
 
-    aiohttp_jinja2.setup(
-        app, loader=jinja2.FileSystemLoader(str(TEMPLATES_ROOT))
-    )
-
+    health.setup_routes(app)
+    metrics.setup_routes(app)
     app.router.add_static('/static/', path=str(PROJECT_ROOT / 'static'))
     setup_maplocate_routes(app, users_handler, roles_handler)
 
     @asyncio.coroutine
     def init():
-        # Setup dependencies
-        yield from init_postgres(inj, config['postgres'], loop)
-        yield from init_redis(inj, config['redis'], loop)
-        tokens = TokensManager(loop=loop)
-        permissions = AuthenticationPolicy()
+        # Setup dependencies, Postgres pool is filled up by warm_up()
+        yield from asyncio.gather(
+            startup.measure('postgres', init_postgres(
+                inj, config['postgres'], loop, lazy=True)),
+            startup.measure('redis', init_redis(inj, config['redis'], loop)),
+            loop=loop)
+        with startup.phase('queries'):
+            queries.compile_all(inj['postgres'].dialect)
+        metrics.add_pool(inj['postgres'])
+        metrics.add_pool(inj['redis'])
+        # Proxies of connections time statements for metrics as well
+        tracer.trace_postgres(inj['postgres'])
+        tracer.trace_redis(inj['redis'])
+        if tracer.enabled:
+            tracer.name_statements(queries)
+            log.info('Tracing statements (slow_threshold=%s, '
+                     'server_timing=%s)', tracer.slow_threshold,
+                     tracer.server_timing)
+        tokens = TokensManager(
+            loop=loop,
+            cache_size=config['sessions_cache']['maxsize'],
+            cache_ttl=config['sessions_cache']['ttl'])
+        permissions = AuthenticationPolicy(
+            loop=loop,
+            cache_size=config['permissions_cache']['maxsize'],
+            cache_ttl=config['permissions_cache']['ttl'])
+        passwords = PasswordsManager.from_config(config['passwords'],
+                                                 loop=loop)
 
         # Inject dependencies
         inj['tokens'] = tokens
         inj['permissions'] = permissions
+        inj['passwords'] = passwords
         inj.inject(tokens)
         inj.inject(permissions)
+        inj.inject(auth_middleware)
         inj.inject(users_handler)
         inj.inject(roles_handler)
+        yield from permissions.subscribe()
+        yield from tokens.subscribe()
 
+    @asyncio.coroutine
+    def listen():
         handler = app.make_handler()
 
-        if not options.unix_socket:
+        if sock is not None and sock.family == socket.AF_UNIX:
+            log.info('Starting maplocate worker on unix socket => %s',
+                     options.unix_socket)
+
+            srv = yield from loop.create_unix_server(handler, sock=sock)
+        elif sock is not None:
+            log.info('Starting maplocate worker => %s:%s',
+                     options.host, options.port)
+
+            srv = yield from loop.create_server(handler, sock=sock)
+        elif not options.unix_socket:
             log.info('Starting maplocate server => %s:%s',
                      options.host, options.port)
 
             srv = yield from loop.create_server(handler,
                                                 options.host,
-                                                options.port)
+                                                options.port,
+                                                reuse_port=options.reuse_port)
         else:
             log.info('Starting maplocate server on unix socket => %s',
                      options.unix_socket)
@@ -100,22 +230,116 @@ def maplocate_handler(options):
 
         return srv, handler
 
+    @asyncio.coroutine
+    def warm_up():
+        try:
+            # Unwrapped, so checkout stats are of requests only
+            yield from startup.measure('warm-up', warm_up_postgres(
+                inj['postgres'].pool, config['postgres']['minsize']))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Postgres pool warm-up failed")
+        health.set_ready()
+        log.info("Maplocate service is ready")
+        startup.log(log)
+        if import_timer.installed:
+            import_timer.log(log)
+            import_timer.uninstall()
+
     run = loop.run_until_complete
-    srv, handler = run(init())
+    srv, handler = run(startup.measure('listen', listen()))
     try:
-        log.info("Maplocate service is started")
-        loop.run_forever()
-    except KeyboardInterrupt:
-        log.info("shutting down...")
+        run(startup.measure('init', init()))
+    except Exception:
         srv.close()
-        run(srv.wait_closed())
-        run(app.shutdown())
-        run(handler.shutdown(timeout=20.0))
-        run(app.cleanup())
+        raise
+    health.set_serving()
+    warm_up_task = loop.create_task(warm_up())
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    log.info("Maplocate service is started")
+    loop.run_forever()
+
+    log.info("shutting down...")
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        # Repeated signal interrupts draining
+        loop.remove_signal_handler(signum)
+    health.set_draining()
+    warm_up_task.cancel()
+    if config['server']['drain_delay']:
+        # Let load balancer notice failing readiness check
+        run(asyncio.sleep(config['server']['drain_delay'], loop=loop))
+    srv.close()
+    run(srv.wait_closed())
+    run(app.shutdown())
+    # Waits in-flight requests, cancels ones left after timeout
+    run(handler.shutdown(timeout=config['server']['shutdown_timeout']))
+    inj['postgres'].log(log)
+    inj['redis'].log(log)
+    run(app.cleanup())
+    run(inj['permissions'].close())
+    run(inj['tokens'].close())
+    inj['passwords'].close()
+    run(inj['redis'].clear())
+    inj['postgres'].close()
+    run(inj['postgres'].wait_closed())
+    loop.close()
+    log.info("Maplocate service is stopped")
+
+admin_maplocate = argsrun.Entry(maplocate_handler, setup_maplocate_parser)
+
+
+def split_admin_index_handler(options):
+    """Moves admin sessions from global Redis index into per-user ones"""
+
+    init_logging(options)
+    config = load_config(options.config, maplocate_trafaret)
+
+    loop = asyncio.get_event_loop()
+    inj = injections.Container()
+    run = loop.run_until_complete
+    run(init_redis(inj, config['redis'], loop))
+    tokens = TokensManager(loop=loop)
+    inj.inject(tokens)
+    try:
+        moved = run(tokens.split_admin_index())
+        log.info("Moved %d admin sessions to per-user indexes", moved)
+    finally:
         run(inj['redis'].clear())
+        loop.close()
+
+split_admin_index = argsrun.Entry(split_admin_index_handler,
+                                  setup_config_parser)
+
+
+def setup_embed_password_salts_parser(ap):
+    setup_config_parser(ap)
+    ap.add_argument('--batch-size',
+                    default=1000,
+                    type=int,
+                    help='Users converted per transaction'
+                         ' (default `%(default)`)')
+
+
+def embed_password_salts_handler(options):
+    """Moves separate password salts into password hashes"""
+
+    init_logging(options)
+    config = load_config(options.config, maplocate_trafaret)
+
+    loop = asyncio.get_event_loop()
+    inj = injections.Container()
+    run = loop.run_until_complete
+    run(init_postgres(inj, config['postgres'], loop, lazy=True))
+    try:
+        converted = run(embed_salts(inj['postgres'],
+                                    batch_size=options.batch_size))
+        log.info("Embedded salts into %d password hashes", converted)
+    finally:
         inj['postgres'].close()
         run(inj['postgres'].wait_closed())
         loop.close()
-        log.info("Maplocate service is stopped")
 
-admin_maplocate = argsrun.Entry(maplocate_handler, setup_maplocate_parser)
+embed_password_salts = argsrun.Entry(embed_password_salts_handler,
+                                     setup_embed_password_salts_parser)
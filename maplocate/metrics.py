@@ -0,0 +1,266 @@
+"""Prometheus metrics of HTTP requests and connection pools.
+
+`Metrics.middleware` records per route (path template, so `{uid}` is not
+expanded) and method:
+
+* responses by status;
+* latency and response size histograms;
+* time spent in Postgres, Redis and JSON serialization.
+
+Route metrics are created once per route with preformatted labels and
+preallocated buckets, so recording a request only increments numbers.
+Postgres and Redis times are times of statements and commands executed
+by request, reported by connection proxies (see `maplocate.tracing`),
+serialization time is reported by JSON renderer. Time connections are
+checked out for is exposed per pool only, as request may hold connection
+while doing something else.
+
+`Metrics.handler` exposes them at /metrics in text exposition format
+together with in-flight requests gauge and stats of registered pools.
+Metrics are of current process, each of pre-forked workers has its own.
+"""
+import asyncio
+import bisect
+import collections
+import time
+
+from aiohttp import web
+
+__all__ = ['Histogram', 'Metrics', 'metrics']
+
+# Upper bounds of histogram buckets, +Inf one is implied
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Kinds of time spent by request, see Metrics.record()
+BACKENDS = ('postgres', 'redis', 'serialization')
+_BACKEND_INDEX = {backend: index for index, backend in enumerate(BACKENDS)}
+
+# (MonitoredPool.stats() key, metric name, type, help)
+POOL_METRICS = [
+    ('size', 'maplocate_pool_connections', 'gauge',
+     'Open connections.'),
+    ('maxsize', 'maplocate_pool_max_connections', 'gauge',
+     'Max connections.'),
+    ('in_use', 'maplocate_pool_connections_in_use', 'gauge',
+     'Connections checked out.'),
+    ('waiting', 'maplocate_pool_waiting', 'gauge',
+     'Coroutines waiting for connection.'),
+    ('checkouts', 'maplocate_pool_checkouts_total', 'counter',
+     'Connection checkouts.'),
+    ('wait_time', 'maplocate_pool_checkout_wait_seconds_total', 'counter',
+     'Time spent waiting for connections.'),
+    ('checkout_time', 'maplocate_pool_checkout_seconds_total', 'counter',
+     'Time connections were checked out for.'),
+    ('timeouts', 'maplocate_pool_checkout_timeouts_total', 'counter',
+     'Checkouts failed by acquire timeout.'),
+    ('recycled', 'maplocate_pool_recycled_total', 'counter',
+     'Connections closed by recycle timeout.'),
+]
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+class Histogram:
+    """Counts of observed values by buckets `bounds`."""
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last one counts values above all bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def expose(self, name, labels):
+        """Yields `name` histogram lines, `labels` are preformatted."""
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            yield '{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound,
+                                                      total)
+        yield '{}_sum{{{}}} {}'.format(name, labels, self.sum)
+        yield '{}_count{{{}}} {}'.format(name, labels, total)
+
+
+class _RouteMetrics:
+
+    __slots__ = ('labels', 'responses', 'latency', 'size', 'backends')
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.responses = collections.Counter()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.size = Histogram(SIZE_BUCKETS)
+        self.backends = [0.0] * len(BACKENDS)
+
+    def observe(self, status, latency, size, timings):
+        self.responses[status] += 1
+        self.latency.observe(latency)
+        self.size.observe(size)
+        for index, seconds in enumerate(timings):
+            self.backends[index] += seconds
+
+
+def _response_size(response):
+    if response is None:
+        return 0
+    if response.prepared:
+        # Streamed, body is sent already
+        return response.body_length
+    # Uncompressed, compression is done on sending
+    return len(getattr(response, 'body', None) or b'')
+
+
+class Metrics:
+
+    path = '/metrics'
+
+    def __init__(self):
+        # Route -> _RouteMetrics
+        self._routes = {}
+        # 404 and 405 ones, made by router for every request
+        self._unmatched = _RouteMetrics('method="",route=""')
+        # Task handling request -> its backend timings
+        self._requests = {}
+        self.in_flight = 0
+        self.pools = []
+
+    def add_pool(self, pool):
+        """Exposes stats of MonitoredPool."""
+        self.pools.append(pool)
+
+    def current(self, loop=None):
+        """Returns backend timings of request handled by current task or
+        None, pass them to record() from callbacks run by other tasks.
+        """
+        if not self._requests:
+            return None
+        return self._requests.get(asyncio.Task.current_task(loop=loop))
+
+    def record(self, backend, seconds, loop=None, *, timings=None):
+        """Adds time spent in one of BACKENDS to `timings` of request,
+        by default to ones of request handled by current task, if any.
+        """
+        if timings is None:
+            timings = self.current(loop)
+            if timings is None:
+                return
+        timings[_BACKEND_INDEX[backend]] += seconds
+
+    def _route_metrics(self, route):
+        try:
+            return self._routes[route]
+        except KeyError:
+            pass
+        if route.resource is None:
+            return self._unmatched
+        info = route.get_info()
+        path = (info.get('formatter') or info.get('path') or
+                info.get('prefix', ''))
+        route_metrics = self._routes[route] = _RouteMetrics(
+            'method="{}",route="{}"'.format(_escape(route.method),
+                                            _escape(path)))
+        return route_metrics
+
+    @asyncio.coroutine
+    def middleware(self, app, handler):
+        @asyncio.coroutine
+        def middleware(request):
+            if request.path == self.path:
+                return (yield from handler(request))
+
+            route_metrics = self._route_metrics(request.match_info.route)
+            task = asyncio.Task.current_task(loop=app.loop)
+            timings = self._requests[task] = [0.0] * len(BACKENDS)
+            self.in_flight += 1
+            started = time.perf_counter()
+            response = None
+            status = 500
+            try:
+                response = yield from handler(request)
+                status = response.status
+                return response
+            except web.HTTPException as exc:
+                response = exc
+                status = exc.status
+                raise
+            finally:
+                latency = time.perf_counter() - started
+                self.in_flight -= 1
+                del self._requests[task]
+                route_metrics.observe(status, latency,
+                                      _response_size(response), timings)
+        return middleware
+
+    def expose(self):
+        """Returns metrics in text exposition format."""
+        routes = list(self._routes.values())
+        if sum(self._unmatched.responses.values()):
+            routes.append(self._unmatched)
+
+        lines = [
+            '# HELP maplocate_http_requests_in_flight Requests being handled.',
+            '# TYPE maplocate_http_requests_in_flight gauge',
+            'maplocate_http_requests_in_flight {}'.format(self.in_flight),
+            '# HELP maplocate_http_requests_total Responses by status.',
+            '# TYPE maplocate_http_requests_total counter',
+        ]
+        for route in routes:
+            for status, count in sorted(route.responses.items()):
+                lines.append('maplocate_http_requests_total'
+                             '{{{},status="{}"}} {}'.format(
+                                 route.labels, status, count))
+
+        for attr, name, help_ in [
+                ('latency', 'maplocate_http_request_duration_seconds',
+                 'Time of handling requests.'),
+                ('size', 'maplocate_http_response_size_bytes',
+                 'Sizes of response bodies.')]:
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} histogram'.format(name))
+            for route in routes:
+                lines.extend(getattr(route, attr).expose(name, route.labels))
+
+        name = 'maplocate_http_request_backend_seconds_total'
+        lines.append('# HELP {} Time spent by requests in backends.'.format(
+            name))
+        lines.append('# TYPE {} counter'.format(name))
+        for route in routes:
+            for backend, seconds in zip(BACKENDS, route.backends):
+                lines.append('{}{{{},backend="{}"}} {}'.format(
+                    name, route.labels, backend, seconds))
+
+        stats = [(pool.label, pool.stats()) for pool in self.pools]
+        for key, name, type_, help_ in POOL_METRICS:
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} {}'.format(name, type_))
+            for label, pool_stats in stats:
+                lines.append('{}{{pool="{}"}} {}'.format(
+                    name, _escape(label), pool_stats[key]))
+
+        lines.append('')
+        return '\n'.join(lines)
+
+    @asyncio.coroutine
+    def handler(self, request):
+        """Request: 'GET', '/metrics'"""
+        return web.Response(
+            body=self.expose().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; '
+                                     'charset=utf-8'})
+
+    def setup_routes(self, app):
+        app.router.add_route('GET', self.path, self.handler)
+
+
+# Wired into app and pools on startup, see maplocate.main
+metrics = Metrics()
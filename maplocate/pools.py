@@ -0,0 +1,165 @@
+"""Connection pools with checkout statistics.
+
+MonitoredPool wraps aiopg.sa.Engine or aioredis.RedisPool keeping their
+interface, so handlers still use ``with (yield from self.postgres) as
+conn:``, and records:
+
+* number of checkouts, total and max time they waited for connection;
+* number of coroutines waiting for connection right now;
+* pool size and connections in use;
+* total time connections were checked out for.
+
+If `wrap(conn)` is set checkouts return what it returns for connection,
+eg proxy tracing statements (see `maplocate.tracing`).
+
+Optionally checkouts fail after `acquire_timeout` seconds and connections
+are closed on release after `recycle` seconds since their first checkout
+(neither of the pools recycles connections itself).
+"""
+import asyncio
+import collections
+import logging
+import time
+import weakref
+
+__all__ = ['MonitoredPool']
+
+log = logging.getLogger(__name__)
+
+
+class _ConnectionContextManager:
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, *args):
+        try:
+            self._pool.release(self._conn)
+        finally:
+            self._pool = self._conn = None
+
+
+class MonitoredPool:
+    """Wraps `pool` counting its checkouts. `raw(conn)` returns closable
+    connection of checked out one (eg DBAPI connection of SAConnection).
+    Other attributes are proxied to wrapped pool.
+    """
+
+    def __init__(self, pool, label, *, loop, acquire_timeout=None,
+                 recycle=None, raw=None, wrap=None, timer=time.monotonic):
+        self.pool = pool
+        self.label = label
+        self.acquire_timeout = acquire_timeout
+        self.recycle = recycle
+        self._loop = loop
+        self._raw = raw or (lambda conn: conn)
+        self.wrap = wrap
+        self._timer = timer
+        # Raw connection -> time of its first checkout
+        self._opened = weakref.WeakKeyDictionary()
+        # Checked out (maybe wrapped) connection -> (connection, time it
+        # was checked out at)
+        self._checked_out = {}
+        self.waiting = 0
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.checkout_time = 0.0
+        self.timeouts = 0
+        self.recycled = 0
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def __repr__(self):
+        return '<MonitoredPool {} {!r}>'.format(self.label, self.pool)
+
+    @property
+    def in_use(self):
+        return self.pool.size - self.pool.freesize
+
+    @asyncio.coroutine
+    def acquire(self):
+        """Checks out connection from wrapped pool.
+        Raises asyncio.TimeoutError after `acquire_timeout` seconds.
+        """
+        started = self._timer()
+        self.waiting += 1
+        try:
+            if self.acquire_timeout is None:
+                conn = yield from self.pool.acquire()
+            else:
+                conn = yield from asyncio.wait_for(
+                    self._acquire(), self.acquire_timeout, loop=self._loop)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            log.warning("No free %s connection in %.3fs, %d in use",
+                        self.label, self.acquire_timeout, self.in_use)
+            raise
+        finally:
+            self.waiting -= 1
+        now = self._timer()
+        wait = now - started
+        self.checkouts += 1
+        self.wait_time += wait
+        if wait > self.max_wait_time:
+            self.max_wait_time = wait
+        if self.recycle is not None:
+            self._opened.setdefault(self._raw(conn), now)
+        if self.wrap is not None:
+            wrapped = self.wrap(conn)
+            self._checked_out[wrapped] = conn, now
+            return wrapped
+        self._checked_out[conn] = conn, now
+        return conn
+
+    @asyncio.coroutine
+    def _acquire(self):
+        return (yield from self.pool.acquire())
+
+    def release(self, conn):
+        """Returns connection to wrapped pool, closing it if it is older
+        than `recycle` seconds.
+        """
+        conn, checked_out = self._checked_out.pop(conn, (conn, None))
+        result = self.pool.release(conn)
+        if checked_out is not None:
+            self.checkout_time += self._timer() - checked_out
+        if self.recycle is not None:
+            raw = self._raw(conn)
+            opened = self._opened.get(raw)
+            if opened is not None and self._timer() - opened > self.recycle:
+                # Closed after release, so waiters are woken up, pools
+                # drop closed free connections on next checkout
+                raw.close()
+                self.recycled += 1
+        return result
+
+    def __iter__(self):
+        # Not a coroutine, enables ``with (yield from pool) as conn:``
+        conn = yield from self.acquire()
+        return _ConnectionContextManager(self, conn)
+
+    def stats(self):
+        """Returns dict of pool gauges and checkout counters."""
+        return collections.OrderedDict([
+            ('size', self.pool.size),
+            ('maxsize', self.pool.maxsize),
+            ('in_use', self.in_use),
+            ('waiting', self.waiting),
+            ('checkouts', self.checkouts),
+            ('wait_time', self.wait_time),
+            ('max_wait_time', self.max_wait_time),
+            ('checkout_time', self.checkout_time),
+            ('timeouts', self.timeouts),
+            ('recycled', self.recycled),
+        ])
+
+    def log(self, logger):
+        logger.info("%s pool: %s", self.label, ', '.join(
+            '{} {}'.format(key, round(value, 3))
+            for key, value in self.stats().items()))
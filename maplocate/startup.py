@@ -0,0 +1,122 @@
+"""Startup time instrumentation.
+
+StartupTimer measures named phases of service boot. ImportTimer measures
+cumulative import time of top-level packages (like ``-X importtime`` of
+Python 3.7+, but summarized and logged); it is installed by
+`maplocate/__init__.py` if MAPLOCATE_IMPORT_TIME environment variable
+is set, as imports are over by the time service code runs.
+"""
+import asyncio
+import collections
+import contextlib
+import importlib.abc
+import sys
+import time
+
+__all__ = ['StartupTimer', 'ImportTimer', 'import_timer']
+
+
+class StartupTimer:
+    """Collects (name, seconds) of startup phases."""
+
+    def __init__(self, timer=time.perf_counter):
+        self.timer = timer
+        self.started = timer()
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = self.timer()
+        try:
+            yield
+        finally:
+            self.phases.append((name, self.timer() - started))
+
+    @asyncio.coroutine
+    def measure(self, name, coro):
+        """Runs coroutine as phase, so parallel phases may be measured."""
+        with self.phase(name):
+            return (yield from coro)
+
+    def log(self, logger):
+        logger.info("Started in %.3fs: %s", self.timer() - self.started,
+                    ', '.join('{} {:.3f}s'.format(name, seconds)
+                              for name, seconds in self.phases))
+
+
+class _TimingLoader(importlib.abc.Loader):
+    """Delegates to original loader, timing module execution."""
+
+    def __init__(self, loader, import_timer):
+        self.loader = loader
+        self.import_timer = import_timer
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Module must not see the wrapper, eg pkg_resources dispatches
+        # on loader type
+        module.__loader__ = module.__spec__.loader = self.loader
+        self.import_timer._enter()
+        started = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.import_timer._exit(module.__name__,
+                                    time.perf_counter() - started)
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """Meta path finder timing imports of modules.
+
+    Time of outermost import is accounted to its top-level package, so
+    nested imports are included into importing package time.
+    """
+
+    def __init__(self):
+        self.times = collections.Counter()
+        self._depth = 0
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    @property
+    def installed(self):
+        return self in sys.meta_path
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+            return spec
+        spec.loader = _TimingLoader(spec.loader, self)
+        return spec
+
+    def _enter(self):
+        self._depth += 1
+
+    def _exit(self, name, seconds):
+        self._depth -= 1
+        if not self._depth:
+            self.times[name.partition('.')[0]] += seconds
+
+    def log(self, logger, limit=15):
+        total = sum(self.times.values())
+        logger.info("Imported in %.3fs: %s", total, ', '.join(
+            '{} {:.3f}s'.format(name, seconds)
+            for name, seconds in self.times.most_common(limit)))
+
+
+import_timer = ImportTimer()
@@ -0,0 +1,313 @@
+"""Timings of Postgres statements and Redis commands of requests.
+
+Once enabled by `Tracer.trace_postgres()` and `Tracer.trace_redis()`,
+connections checked out from pools are wrapped into proxies recording a
+span (statement name, duration and rows) of every statement executed.
+Registered statements (see `maplocate.db.queries`) are named by their
+registry names, others by SQL keyword and table, eg ``update user``.
+Other code may be timed as well::
+
+    with tracer.span('app', 'hash password'):
+        ...
+
+Spans are collected per request by `Tracer.middleware`. Statements
+slower than `slow_threshold` seconds are logged with request they were
+executed by. If `server_timing` is set, responses have Server-Timing
+header summing up spans by name, eg::
+
+    Server-Timing: pg.user_by_id;dur=0.512;desc="x1 rows=1",
+        redis.GET;dur=0.201;desc="x1", total;dur=1.754
+
+It is meant for debugging, as it discloses statement names. Connections
+are wrapped anyway, as proxies account time of statements to request
+metrics (see `maplocate.metrics`), but spans are neither recorded nor
+logged unless tracer is enabled.
+"""
+import asyncio
+import collections
+import contextlib
+import functools
+import logging
+import re
+import time
+
+from aiohttp import web
+
+from maplocate.metrics import metrics
+
+__all__ = ['Span', 'Trace', 'Tracer', 'tracer']
+
+log = logging.getLogger(__name__)
+
+_SQL_KEYWORD_RE = re.compile(r'\s*(\w+)')
+# Characters not allowed in Server-Timing metric names
+_NON_TOKEN_RE = re.compile(r"[^\w!#$%&'*+.^`|~-]")
+
+
+class Span:
+
+    __slots__ = ('kind', 'name', 'duration', 'rows')
+
+    def __init__(self, kind, name, duration, rows=None):
+        self.kind = kind
+        self.name = name
+        self.duration = duration
+        self.rows = rows
+
+    def __repr__(self):
+        return '<Span {}.{} {:.6f}s rows={}>'.format(
+            self.kind, self.name, self.duration, self.rows)
+
+
+class Trace:
+    """Spans of request."""
+
+    __slots__ = ('method', 'path', 'spans')
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.spans = []
+
+    def server_timing(self, total):
+        """Returns Server-Timing header value of spans summed up by name
+        and of `total` seconds of request.
+        """
+        # (kind, name) -> [duration, count, rows]
+        sums = collections.OrderedDict()
+        for span in self.spans:
+            key = span.kind, span.name
+            entry = sums.get(key)
+            if entry is None:
+                entry = sums[key] = [0.0, 0, None]
+            entry[0] += span.duration
+            entry[1] += 1
+            if span.rows is not None:
+                entry[2] = (entry[2] or 0) + span.rows
+        metrics = []
+        for (kind, name), (duration, count, rows) in sums.items():
+            desc = 'x{}'.format(count)
+            if rows is not None:
+                desc += ' rows={}'.format(rows)
+            metrics.append('{};dur={:.3f};desc="{}"'.format(
+                _NON_TOKEN_RE.sub('_', '{}.{}'.format(kind, name)),
+                duration * 1000, desc))
+        metrics.append('total;dur={:.3f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+
+def _table_name(selectable):
+    name = getattr(selectable, 'name', None)
+    if name is None and hasattr(selectable, 'left'):
+        # Join
+        return _table_name(selectable.left)
+    return name
+
+
+def statement_name(statement):
+    """Returns name of unregistered SQLAlchemy statement or SQL string."""
+    if not isinstance(statement, str):
+        # TextClause
+        statement = getattr(statement, 'text', statement)
+    if isinstance(statement, str):
+        match = _SQL_KEYWORD_RE.match(statement)
+        return match.group(1).lower() if match else 'sql'
+    kind = getattr(statement, '__visit_name__', 'sql')
+    table = getattr(statement, 'table', None)
+    if table is not None:
+        # Insert, update or delete
+        return '{} {}'.format(kind, table.name)
+    for from_ in getattr(statement, 'froms', ()):
+        name = _table_name(from_)
+        if name is not None:
+            return '{} {}'.format(kind, name)
+    return kind
+
+
+class _PostgresConnection:
+    """Proxy of aiopg.sa.SAConnection timing its statements."""
+
+    def __init__(self, conn, tracer):
+        self._conn = conn
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    @asyncio.coroutine
+    def execute(self, query, *multiparams, **params):
+        trace = self._tracer.current()
+        timings = metrics.current()
+        rows = None
+        started = time.perf_counter()
+        try:
+            result = yield from self._conn.execute(
+                query, *multiparams, **params)
+            rows = result.rowcount
+            return result
+        finally:
+            self._done(trace, timings, query, started, rows)
+
+    @asyncio.coroutine
+    def scalar(self, query, *multiparams, **params):
+        trace = self._tracer.current()
+        timings = metrics.current()
+        started = time.perf_counter()
+        try:
+            return (yield from self._conn.scalar(
+                query, *multiparams, **params))
+        finally:
+            self._done(trace, timings, query, started)
+
+    def _done(self, trace, timings, query, started, rows=None):
+        duration = time.perf_counter() - started
+        if timings is not None:
+            metrics.record('postgres', duration, timings=timings)
+        if self._tracer.enabled:
+            self._tracer.record(trace, 'pg',
+                                self._tracer.statement_name(query),
+                                duration, rows)
+
+
+class _RedisConnection:
+    """Proxy of aioredis.RedisConnection timing its commands, pipelined
+    and transaction ones included.
+    """
+
+    def __init__(self, conn, tracer):
+        self._conn = conn
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def execute(self, command, *args, **kwargs):
+        # Replies are resolved by connection reader, not by request's task
+        trace = self._tracer.current()
+        timings = metrics.current()
+        started = time.perf_counter()
+        fut = self._conn.execute(command, *args, **kwargs)
+        fut.add_done_callback(functools.partial(
+            self._done, trace, timings, command, started))
+        return fut
+
+    def _done(self, trace, timings, command, started, fut):
+        duration = time.perf_counter() - started
+        if timings is not None:
+            metrics.record('redis', duration, timings=timings)
+        if self._tracer.enabled:
+            if isinstance(command, bytes):
+                command = command.decode('ascii', 'replace')
+            self._tracer.record(trace, 'redis', command.upper(), duration)
+
+    @asyncio.coroutine
+    def get_atomic_connection(self):
+        # Pipelines and transactions send commands by execute() of it
+        return self
+
+
+class Tracer:
+
+    def __init__(self):
+        self.slow_threshold = None
+        self.server_timing = False
+        # Task handling request -> its Trace
+        self._traces = {}
+        # SQL of registered statements -> their names
+        self._statements = {}
+
+    def configure(self, *, slow_threshold=None, server_timing=False):
+        self.slow_threshold = slow_threshold
+        self.server_timing = server_timing
+
+    @property
+    def enabled(self):
+        return self.slow_threshold is not None or self.server_timing
+
+    def name_statements(self, queries):
+        """Names statements of compiled QueryRegistry by registry names."""
+        self._statements.update(
+            (query.sql, query.name) for query in queries
+            if query.sql is not None)
+
+    def statement_name(self, statement):
+        if isinstance(statement, str):
+            name = self._statements.get(statement)
+            if name is not None:
+                return name
+        return statement_name(statement)
+
+    def trace_postgres(self, pool):
+        """Makes MonitoredPool of aiopg.sa.Engine check out connections
+        timing their statements.
+        """
+        pool.wrap = functools.partial(_PostgresConnection, tracer=self)
+
+    def trace_redis(self, pool):
+        """Makes MonitoredPool of aioredis.RedisPool check out connections
+        timing their commands.
+        """
+        def wrap(redis):
+            # Commands object of the same class on traced connection
+            return type(redis)(_RedisConnection(redis.connection, self))
+        pool.wrap = wrap
+
+    def current(self, loop=None):
+        """Returns Trace of request handled by current task or None."""
+        if not self._traces:
+            return None
+        return self._traces.get(asyncio.Task.current_task(loop=loop))
+
+    def record(self, trace, kind, name, duration, rows=None):
+        """Adds span to `trace` (if any) and logs it if it is slow."""
+        if trace is not None:
+            trace.spans.append(Span(kind, name, duration, rows))
+        if (self.slow_threshold is not None and
+                duration >= self.slow_threshold):
+            log.warning("Slow %s %s: %.3fs, rows %s, request %s", kind, name,
+                        duration, rows,
+                        '{} {}'.format(trace.method, trace.path)
+                        if trace is not None else None)
+
+    @contextlib.contextmanager
+    def span(self, kind, name):
+        """Records span of code executed in context."""
+        if not self.enabled:
+            yield
+            return
+        trace = self.current()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(trace, kind, name, time.perf_counter() - started)
+
+    @asyncio.coroutine
+    def middleware(self, app, handler):
+        if not self.enabled:
+            return handler
+
+        @asyncio.coroutine
+        def middleware(request):
+            task = asyncio.Task.current_task(loop=app.loop)
+            trace = self._traces[task] = Trace(request.method, request.path)
+            started = time.perf_counter()
+            response = None
+            try:
+                response = yield from handler(request)
+                return response
+            except web.HTTPException as exc:
+                response = exc
+                raise
+            finally:
+                del self._traces[task]
+                # Headers of streamed responses are sent already
+                if (self.server_timing and response is not None and
+                        not response.prepared):
+                    response.headers['Server-Timing'] = trace.server_timing(
+                        time.perf_counter() - started)
+        return middleware
+
+
+# Configured on startup, see maplocate.main
+tracer = Tracer()
@@ -0,0 +1,209 @@
+"""Pre-fork worker processes.
+
+Supervisor forks workers sharing listening socket bound by parent (or
+binding their own ones with SO_REUSEPORT) and keeps their number:
+
+* crashed workers are restarted, with delay if they crash on startup;
+* SIGHUP starts new generation of workers and gracefully stops old one;
+* SIGTERM and SIGINT gracefully stop all workers, stragglers are killed
+  after `stop_timeout`.
+
+Each worker creates its own event loop, Postgres and Redis pools after
+fork, nothing of them is shared.
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+__all__ = ['Supervisor', 'bind_socket', 'bind_unix_socket']
+
+log = logging.getLogger(__name__)
+
+SIGNALS = {signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM, signal.SIGINT}
+
+
+def bind_socket(host, port, *, backlog=100):
+    """Returns listening TCP socket to be inherited by workers."""
+    family, type_, proto, _, address = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def bind_unix_socket(path, *, backlog=100):
+    """Returns listening unix socket, stale socket file is replaced."""
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class Supervisor:
+    """Runs `worker()` in `count` child processes.
+
+    `worker()` must stop gracefully on SIGTERM and return exit code.
+    `on_reload()` is called in parent on SIGHUP before new workers are
+    forked, so they see its effects (eg reloaded config). Code is not
+    reloaded, restart supervisor to upgrade.
+    """
+
+    def __init__(self, worker, count, *, on_reload=None, stop_timeout=30,
+                 min_uptime=1.0, restart_delay=1.0):
+        assert count > 0, count
+        self.worker = worker
+        self.count = count
+        self.on_reload = on_reload
+        self.stop_timeout = stop_timeout
+        self.min_uptime = min_uptime
+        self.restart_delay = restart_delay
+        # pid -> start time of current generation workers
+        self._workers = {}
+        # Workers of previous generations being stopped
+        self._retiring = set()
+        # Due times of delayed restarts
+        self._restarts = []
+        self._stopping = False
+
+    def run(self):
+        """Forks workers and supervises them until stopped by signal."""
+        # Signals are received synchronously by sigtimedwait(), so they
+        # never interrupt fork or waitpid.
+        signal.signal(signal.SIGCHLD, self._noop)
+        old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+        try:
+            log.info("Starting %d workers", self.count)
+            for _ in range(self.count):
+                self._spawn(old_mask)
+            while self._workers or self._retiring or self._restarts:
+                self._loop(old_mask)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        log.info("All workers are stopped")
+
+    def _loop(self, old_mask):
+        timeout = 1.0
+        if self._restarts:
+            timeout = max(min(self._restarts) - time.monotonic(), 0)
+        info = signal.sigtimedwait(SIGNALS, timeout)
+        signum = info.si_signo if info is not None else None
+
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            self._stop()
+        elif signum == signal.SIGHUP and not self._stopping:
+            self._reload(old_mask)
+
+        self._reap()
+
+        now = time.monotonic()
+        due = [when for when in self._restarts if when <= now]
+        for when in due:
+            self._restarts.remove(when)
+            if not self._stopping:
+                self._spawn(old_mask)
+
+        if self._stopping and now >= self._kill_at:
+            for pid in list(self._workers) + list(self._retiring):
+                log.warning("Killing worker %d", pid)
+                self._kill(pid, signal.SIGKILL)
+
+    def _spawn(self, old_mask):
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = time.monotonic()
+            log.info("Started worker %d", pid)
+            return
+
+        # Child process
+        code = 1
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+            code = self.worker() or 0
+        except SystemExit as exc:
+            # The same as interpreter does, os._exit() takes int only
+            if exc.code is None:
+                code = 0
+            elif isinstance(exc.code, int):
+                code = exc.code
+            else:
+                print(exc.code, file=sys.stderr)
+                code = 1
+        except BaseException:
+            log.exception("Worker %d failed", os.getpid())
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+                log.info("Stopped old worker %d", pid)
+                continue
+            started = self._workers.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+            log.error("Worker %d exited with status %d, restarting",
+                      pid, status)
+            delay = 0
+            if time.monotonic() - started < self.min_uptime:
+                # Likely fails on startup, do not fork in tight loop
+                delay = self.restart_delay
+            self._restarts.append(time.monotonic() + delay)
+
+    def _reload(self, old_mask):
+        log.info("Reloading workers")
+        if self.on_reload is not None:
+            try:
+                self.on_reload()
+            except Exception:
+                log.exception("Reload failed, workers are kept")
+                return
+        old = list(self._workers)
+        self._workers.clear()
+        self._restarts.clear()
+        for _ in range(self.count):
+            self._spawn(old_mask)
+        # New workers share the socket, so old ones may just drain
+        for pid in old:
+            self._retiring.add(pid)
+            self._kill(pid, signal.SIGTERM)
+
+    def _stop(self):
+        if self._stopping:
+            return
+        log.info("Stopping workers")
+        self._stopping = True
+        self._kill_at = time.monotonic() + self.stop_timeout
+        self._restarts.clear()
+        for pid in list(self._workers) + list(self._retiring):
+            self._kill(pid, signal.SIGTERM)
+
+    @staticmethod
+    def _kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def _noop(signum, frame):
+        pass
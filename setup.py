@@ -35,6 +35,8 @@ setup(name='maplocate',
               ],
           'maplocate': [
               'serve-admin = maplocate.main:admin_maplocate',
+              'split-admin-index = maplocate.main:split_admin_index',
+              'embed-password-salts = maplocate.main:embed_password_salts',
               ]},
       zip_safe=False)
 
@@ -0,0 +1,56 @@
+from maplocate.admin.cache import TTLCache
+
+
+class FakeTimer:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+class TestTTLCache:
+
+    def make_cache(self, maxsize=2, ttl=10):
+        timer = FakeTimer()
+        return TTLCache(maxsize=maxsize, ttl=ttl, timer=timer), timer
+
+    def test_get_set(self):
+        cache, _ = self.make_cache()
+        cache.set('a', 1)
+        assert cache.get('a') == 1
+        assert 'a' in cache
+        assert cache.get('b') is None
+
+    def test_expiration(self):
+        cache, timer = self.make_cache()
+        cache.set('a', 1)
+        timer.now = 10
+        assert cache.get('a', 'missing') == 'missing'
+        assert len(cache) == 0
+
+    def test_lru_eviction(self):
+        cache, _ = self.make_cache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+
+    def test_items(self):
+        cache, _ = self.make_cache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.items() == [('a', 1), ('b', 2)]
+
+    def test_pop_and_clear(self):
+        cache, _ = self.make_cache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.pop('a') == 1
+        assert cache.pop('a') is None
+        cache.clear()
+        assert len(cache) == 0
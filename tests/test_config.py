@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+if not hasattr(asyncio, 'coroutine'):
+    pytest.skip('generator-based coroutines are not supported',
+                allow_module_level=True)
+
+pytest.importorskip('yaml')
+pytest.importorskip('aiopg')
+pytest.importorskip('aioredis')
+t = pytest.importorskip('trafaret')
+
+from maplocate.config import PostgresConf, RedisConf, warm_up_postgres  # noqa
+
+
+class FakeEngine:
+    """Opens connections on checkout while there are no free ones."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 1
+        self.free = [object()]
+
+    @asyncio.coroutine
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        assert self.size < self.maxsize, 'pool is exhausted'
+        self.size += 1
+        return object()
+
+    def release(self, conn):
+        self.free.append(conn)
+
+
+class TestConfig:
+
+    def test_pool_sizes(self):
+        conf = PostgresConf.check({'database': 'maplocate', 'user': 'user',
+                                   'password': 'secret', 'minsize': 5,
+                                   'maxsize': 5})
+        assert conf['minsize'] == conf['maxsize'] == 5
+        with pytest.raises(t.DataError):
+            PostgresConf.check({'database': 'maplocate', 'user': 'user',
+                                'password': 'secret', 'minsize': 20})
+        with pytest.raises(t.DataError):
+            RedisConf.check({'address': 'redis', 'minsize': 2,
+                             'maxsize': 1})
+
+    def test_warm_up_above_maxsize(self):
+        loop = asyncio.new_event_loop()
+        engine = FakeEngine(maxsize=3)
+        try:
+            loop.run_until_complete(asyncio.wait_for(
+                warm_up_postgres(engine, 10), 1, loop=loop))
+        finally:
+            loop.close()
+        assert engine.size == 3
+        assert len(engine.free) == 3
@@ -0,0 +1,59 @@
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from maplocate.metrics import Histogram, Metrics  # noqa
+
+
+class FakePool:
+
+    label = 'postgres'
+
+    def stats(self):
+        return {'size': 2, 'maxsize': 10, 'in_use': 1, 'waiting': 0,
+                'checkouts': 5, 'wait_time': 0.5, 'checkout_time': 2.0,
+                'timeouts': 0, 'recycled': 0}
+
+
+class TestHistogram:
+
+    def test_buckets(self):
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        assert histogram.counts == [2, 1, 1]
+        assert list(histogram.expose('h', 'a="b"')) == [
+            'h_bucket{a="b",le="1"} 2',
+            'h_bucket{a="b",le="10"} 3',
+            'h_bucket{a="b",le="+Inf"} 4',
+            'h_sum{a="b"} 56.5',
+            'h_count{a="b"} 4',
+        ]
+
+
+class TestMetrics:
+
+    def test_expose_pools(self):
+        metrics = Metrics()
+        pool = FakePool()
+        metrics.add_pool(pool)
+        lines = metrics.expose().splitlines()
+        assert 'maplocate_http_requests_in_flight 0' in lines
+        assert 'maplocate_pool_connections_in_use{pool="postgres"} 1' in lines
+        assert ('maplocate_pool_checkout_wait_seconds_total'
+                '{pool="postgres"} 0.5') in lines
+        assert ('maplocate_pool_checkout_seconds_total'
+                '{pool="postgres"} 2.0') in lines
+
+    def test_record_outside_request(self):
+        metrics = Metrics()
+        metrics.record('postgres', 1.0)
+        assert not metrics._requests
+        assert metrics.current() is None
+
+    def test_record_timings(self):
+        metrics = Metrics()
+        timings = [0.0, 0.0, 0.0]
+        metrics.record('redis', 0.5, timings=timings)
+        metrics.record('serialization', 0.25, timings=timings)
+        assert timings == [0.0, 0.5, 0.25]
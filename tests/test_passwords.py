@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+if not hasattr(asyncio, 'coroutine'):
+    pytest.skip('generator-based coroutines are not supported',
+                allow_module_level=True)
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('sqlalchemy')
+
+from maplocate.admin.passwords import embed_salt, embed_salts  # noqa
+
+
+class FakeResult:
+
+    def __init__(self, rowcount):
+        self.rowcount = rowcount
+
+
+class FakePostgres:
+    """Pool of connection updating `left` rows by batches."""
+
+    def __init__(self, left):
+        self.left = left
+        self.checkouts = 0
+
+    def __iter__(self):
+        # Enables ``with (yield from pool) as conn:`` as MonitoredPool does
+        self.checkouts += 1
+        yield from ()
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    @asyncio.coroutine
+    def execute(self, query, batch_size):
+        rowcount = min(self.left, batch_size)
+        self.left -= rowcount
+        return FakeResult(rowcount)
+
+
+class TestPasswords:
+
+    def test_embed_salt(self):
+        assert embed_salt('abc', 'salt') == 'sha512$salt$abc'
+        assert embed_salt('pbkdf2_sha256$1000$abc', 'salt') == (
+            'pbkdf2_sha256$1000$salt$abc')
+
+    def test_embed_salts(self):
+        postgres = FakePostgres(left=25)
+        loop = asyncio.new_event_loop()
+        try:
+            converted = loop.run_until_complete(
+                embed_salts(postgres, batch_size=10))
+        finally:
+            loop.close()
+        assert converted == 25
+        assert postgres.left == 0
+        # Connection is returned after every batch
+        assert postgres.checkouts == 4
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+if not hasattr(asyncio, 'coroutine'):
+    pytest.skip('generator-based coroutines are not supported',
+                allow_module_level=True)
+
+from maplocate.pools import MonitoredPool  # noqa
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool:
+
+    def __init__(self, loop, maxsize=1):
+        self.maxsize = maxsize
+        self.free = [FakeConnection() for _ in range(maxsize)]
+        self.released = []
+        self.cond = asyncio.Condition(loop=loop)
+
+    @property
+    def size(self):
+        return self.maxsize
+
+    @property
+    def freesize(self):
+        return len(self.free)
+
+    @asyncio.coroutine
+    def acquire(self):
+        with (yield from self.cond):
+            while not self.free:
+                yield from self.cond.wait()
+            return self.free.pop()
+
+    def release(self, conn):
+        self.released.append(conn)
+        self.free.append(conn)
+
+
+class FakeTimer:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMonitoredPool:
+
+    def setup_method(self, method):
+        self.loop = asyncio.new_event_loop()
+        self.timer = FakeTimer()
+
+    def teardown_method(self, method):
+        self.loop.close()
+
+    def make_pool(self, **kwargs):
+        return MonitoredPool(FakePool(self.loop), 'fake', loop=self.loop,
+                             timer=self.timer, **kwargs)
+
+    def test_checkout_stats(self):
+        pool = self.make_pool()
+
+        @asyncio.coroutine
+        def use():
+            with (yield from pool) as conn:
+                self.timer.now += 2
+                assert pool.in_use == 1
+            return conn
+
+        conn = self.loop.run_until_complete(use())
+        assert pool.pool.released == [conn]
+        stats = pool.stats()
+        assert stats['in_use'] == 0
+        assert stats['checkouts'] == 1
+        assert stats['checkout_time'] == 2
+        assert stats['waiting'] == 0
+        assert pool.maxsize == 1
+
+    def test_acquire_timeout(self):
+        pool = self.make_pool(acquire_timeout=0.01)
+        conn = self.loop.run_until_complete(pool.acquire())
+        with pytest.raises(asyncio.TimeoutError):
+            self.loop.run_until_complete(pool.acquire())
+        assert pool.timeouts == 1
+        assert pool.waiting == 0
+        pool.release(conn)
+
+    def test_recycle(self):
+        pool = self.make_pool(recycle=10)
+        conn = self.loop.run_until_complete(pool.acquire())
+        pool.release(conn)
+        assert not conn.closed
+        conn = self.loop.run_until_complete(pool.acquire())
+        self.timer.now = 11
+        pool.release(conn)
+        assert conn.closed
+        assert pool.recycled == 1
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+sa = pytest.importorskip('sqlalchemy')
+
+from maplocate.db import scheme as db  # noqa
+from maplocate.db.queries import QueryRegistry  # noqa
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.executed = []
+
+    @asyncio.coroutine
+    def execute(self, sql, params):
+        self.executed.append((sql, params))
+
+
+class TestQueryRegistry:
+
+    def test_compiled_once(self):
+        registry = QueryRegistry()
+        query = registry.register(
+            'user_by_id',
+            db.user.select().where(db.user.c.id == sa.bindparam('user_id')))
+        registry.compile_all()
+        conn = FakeConnection()
+        loop = asyncio.new_event_loop()
+        try:
+            for user_id in (1, 2):
+                loop.run_until_complete(query.execute(conn, user_id=user_id))
+        finally:
+            loop.close()
+
+        assert '%(user_id)s' in query.sql
+        assert conn.executed == [(query.sql, {'user_id': 1}),
+                                 (query.sql, {'user_id': 2})]
+        assert registry.stats() == {'user_by_id': (2, 1)}
+
+    def test_duplicated_name(self):
+        registry = QueryRegistry()
+        registry.register('roles', db.roles.select())
+        with pytest.raises(ValueError):
+            registry.register('roles', db.roles.select())
@@ -0,0 +1,56 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from maplocate.admin.serializers import (  # noqa
+    ENCODERS, get_encoder, JSONArrayWriter)
+
+
+class FakeResponse:
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+
+class TestSerializers:
+
+    @pytest.mark.parametrize('name', list(ENCODERS))
+    def test_encoders(self, name):
+        try:
+            _, dumps = get_encoder(name)
+        except ImportError:
+            pytest.skip('{} is not installed'.format(name))
+        data = {'login': 'bob@email.com', 'name': 'Боб', 'roles': [1, 2]}
+        encoded = dumps(data)
+        assert isinstance(encoded, bytes)
+        assert json.loads(encoded.decode('utf-8')) == data
+
+    @pytest.mark.parametrize('items', [[], [1], list(range(100))])
+    def test_array_writer(self, items):
+        response = FakeResponse()
+        _, dumps = get_encoder('json')
+        writer = JSONArrayWriter(response, dumps=dumps, buffer_size=16)
+
+        @asyncio.coroutine
+        def write():
+            for item in items:
+                writer.write(item)
+                yield from writer.flush()
+            yield from writer.close()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(write())
+        finally:
+            loop.close()
+        assert json.loads(b''.join(response.chunks).decode('utf-8')) == items
@@ -0,0 +1,170 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+sa = pytest.importorskip('sqlalchemy')
+
+from maplocate import tracing  # noqa
+from maplocate.metrics import Metrics  # noqa
+from maplocate.tracing import Span, Trace, Tracer, statement_name  # noqa
+
+
+class TestTracing:
+
+    def test_statement_name(self):
+        table = sa.table('user', sa.column('id'), sa.column('login'))
+        other = sa.table('roles', sa.column('id'))
+        assert statement_name(table.select()) == 'select user'
+        assert statement_name(table.update()) == 'update user'
+        assert statement_name(
+            sa.select([table]).select_from(
+                table.join(other, table.c.id == other.c.id))) == 'select user'
+        assert statement_name(sa.text('INSERT INTO user ...')) == 'insert'
+        assert statement_name('\n  FETCH 500 FROM users') == 'fetch'
+
+    def test_registered_name(self):
+        class Query:
+            name = 'user_by_id'
+            sql = 'SELECT * FROM user WHERE id = %(user_id)s'
+
+        tracer = Tracer()
+        tracer.name_statements([Query])
+        assert tracer.statement_name(Query.sql) == 'user_by_id'
+        assert tracer.statement_name('SELECT 1') == 'select'
+
+    def test_server_timing(self):
+        trace = Trace('GET', '/admin/users/1')
+        trace.spans = [Span('pg', 'user_by_id', 0.001, 1),
+                       Span('redis', 'GET', 0.0005),
+                       Span('pg', 'user_by_id', 0.002, 0)]
+        assert trace.server_timing(0.01) == (
+            'pg.user_by_id;dur=3.000;desc="x2 rows=1", '
+            'redis.GET;dur=0.500;desc="x1", total;dur=10.000')
+
+    def test_slow_log(self, caplog):
+        tracer = Tracer()
+        tracer.configure(slow_threshold=0.1)
+        assert tracer.enabled
+        trace = Trace('GET', '/admin/users/1')
+        tracer.record(trace, 'pg', 'fast', 0.01)
+        tracer.record(trace, 'pg', 'slow', 0.2, 5)
+        assert [span.name for span in trace.spans] == ['fast', 'slow']
+        assert [record.getMessage() for record in caplog.records] == [
+            'Slow pg slow: 0.200s, rows 5, request GET /admin/users/1']
+
+
+class FakeResult:
+
+    rowcount = 1
+
+
+class FakeSAConnection:
+
+    @asyncio.coroutine
+    def execute(self, query, *multiparams, **params):
+        yield from asyncio.sleep(0.001)
+        return FakeResult()
+
+
+class TestPostgresMetrics:
+
+    def test_statement_time(self, monkeypatch):
+        metrics = Metrics()
+        timings = [0.0, 0.0, 0.0]
+        metrics.current = lambda loop=None: timings
+        monkeypatch.setattr(tracing, 'metrics', metrics)
+        tracer = Tracer()
+        conn = tracing._PostgresConnection(FakeSAConnection(), tracer)
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(conn.execute('SELECT 1'))
+        finally:
+            loop.close()
+        assert result.rowcount == 1
+        # Accounted to request even though tracer is disabled
+        assert timings[0] >= 0.001
+        assert timings[1:] == [0.0, 0.0]
+
+
+class FakeRedisConnection:
+    """Replies OK to SET, 1 to other commands, queues them between MULTI
+    and EXEC.
+    """
+
+    closed = False
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._queued = None
+        self.commands = []
+
+    def execute(self, command, *args, **kwargs):
+        if isinstance(command, str):
+            command = command.encode('ascii')
+        self.commands.append(command.upper())
+        fut = asyncio.Future(loop=self._loop)
+        reply = b'OK' if command.upper() == b'SET' else 1
+        if command.upper() == b'MULTI':
+            self._queued = []
+            fut.set_result(b'OK')
+        elif command.upper() == b'EXEC':
+            fut.set_result(self._queued)
+            self._queued = None
+        elif self._queued is not None:
+            self._queued.append(reply)
+            fut.set_result(b'QUEUED')
+        else:
+            fut.set_result(reply)
+        return fut
+
+
+class FakePool:
+
+    wrap = None
+
+
+class TestRedisTracing:
+
+    def setup_method(self, method):
+        aioredis = pytest.importorskip('aioredis')
+        self.loop = asyncio.new_event_loop()
+        self.conn = FakeRedisConnection(self.loop)
+        self.trace = Trace('POST', '/auth/login')
+        self.tracer = Tracer()
+        self.tracer.configure(server_timing=True)
+        self.tracer.current = lambda loop=None: self.trace
+        pool = FakePool()
+        self.tracer.trace_redis(pool)
+        self.redis = pool.wrap(aioredis.Redis(self.conn))
+
+    def teardown_method(self, method):
+        self.loop.close()
+
+    def test_multi_exec(self):
+        tr = self.redis.multi_exec()
+        tr.set('key', 'value')
+        tr.expire('key', 10)
+        result = self.loop.run_until_complete(tr.execute())
+        assert result == [True, True]
+        assert self.conn.commands == [b'MULTI', b'SET', b'EXPIRE', b'EXEC']
+        assert [span.name for span in self.trace.spans] == [
+            'MULTI', 'SET', 'EXPIRE', 'EXEC']
+
+    def test_command_time(self, monkeypatch):
+        timings = [0.0, 0.0, 0.0]
+        # Replies are resolved out of request task, so timings of request
+        # are taken when command is sent
+        monkeypatch.setattr(tracing.metrics, 'current',
+                            lambda loop=None: timings)
+        self.loop.run_until_complete(self.redis.set('key', 'value'))
+        assert timings[1] > 0
+        assert timings[0] == timings[2] == 0
+
+    def test_pipeline(self):
+        pipe = self.redis.pipeline()
+        pipe.set('key', 'value')
+        pipe.delete('other')
+        result = self.loop.run_until_complete(pipe.execute())
+        assert result == [True, 1]
+        assert [span.name for span in self.trace.spans] == ['SET', 'DEL']
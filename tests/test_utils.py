@@ -0,0 +1,28 @@
+import pytest
+
+web = pytest.importorskip('aiohttp.web')
+
+from maplocate.admin.utils import check_etag  # noqa
+
+
+class FakeRequest:
+
+    def __init__(self, **headers):
+        self.headers = headers
+
+
+class TestCheckEtag:
+
+    @pytest.mark.parametrize('if_none_match', [
+        'W/"roles-2"', '"roles-2"', '"roles-1", W/"roles-2"', '*'])
+    def test_not_modified(self, if_none_match):
+        with pytest.raises(web.HTTPNotModified) as exc_info:
+            check_etag(FakeRequest(**{'If-None-Match': if_none_match}),
+                       'W/"roles-2"')
+        assert exc_info.value.headers['ETag'] == 'W/"roles-2"'
+        assert 'Content-Type' not in exc_info.value.headers
+
+    @pytest.mark.parametrize('headers', [
+        {}, {'If-None-Match': 'W/"roles-1"'}, {'If-None-Match': '"roles-20"'}])
+    def test_modified(self, headers):
+        check_etag(FakeRequest(**headers), 'W/"roles-2"')
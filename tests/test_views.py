@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from maplocate.admin.views import make_view, UserView, RoleView  # noqa
+
+
+class TestViews:
+
+    def test_make_view(self):
+        view = make_view('View', ['id', 'name'], rename={'id': 'uid'},
+                         computed={'size': lambda row: len(row['name'])})
+        assert view({'id': 1, 'name': 'Bob', 'password': 'secret'}) == {
+            'uid': 1, 'name': 'Bob', 'size': 3}
+
+    def test_user_view(self):
+        user = {'id': 1, 'login': 'bob@email.com', 'password': 'hash',
+                'salt': None, 'is_superuser': False, 'firstname': 'Bob',
+                'lastname': 'Last', 'disabled': False,
+                'fullname_search': 'bob last',
+                'roles': [{'user_id': 1, 'id': 2, 'role_name': 'Admins'}]}
+        assert UserView(user) == {
+            'uid': 1, 'login': 'bob@email.com', 'is_superuser': False,
+            'firstname': 'Bob', 'lastname': 'Last', 'disabled': False,
+            'roles': [{'id': 2, 'role_name': 'Admins'}]}
+        del user['roles']
+        assert UserView(user)['roles'] == []
+        user['phone'] = '+1 555 0100'
+        assert 'phone' not in UserView(user)
+
+    def test_role_view(self):
+        role = {'id': 2, 'role_name': 'Admins', 'permissions': None,
+                'description': ''}
+        assert RoleView(role) == dict(role, permissions=[])
+        role['created_by'] = 1
+        assert 'created_by' not in RoleView(role)